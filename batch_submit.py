@@ -0,0 +1,223 @@
+"""
+Обработка отзывов через OpenAI Batch API.
+
+Для неинтерактивных запусков пайплайна все отзывы отправляются одним пакетом:
+провайдер выполняет их в течение окна обработки со скидкой 50% к обычной цене.
+Поддерживаются только модели OpenAI (gpt-*).
+"""
+
+import io
+import json
+import os
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from review_checker import build_review_prompt
+from process_reviews import apply_check_result
+from llm.llm_response_cleaner import clean_llm_content
+from logger_config import get_process_logger
+
+logger = get_process_logger()
+
+PRICING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm", "llm_pricing.json")
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_DISCOUNT = 0.5  # Batch API стоит вдвое дешевле обычных запросов
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+BATCH_MAX_WAIT = 60 * 60  # Сколько секунд ждать пакет, прежде чем отменить его
+
+
+def supports_batch(model: str) -> bool:
+    """Проверяет, можно ли обработать модель через Batch API."""
+    return model.startswith("gpt-")
+
+
+def build_batch_lines(groups: list, model: str) -> list:
+    """
+    Формирует строки JSONL для Batch API.
+
+    Args:
+        groups: Список групп одинаковых отзывов [(sheet_name, worksheet_name, index, review), ...]
+        model: Модель для обработки
+
+    Returns:
+        Список JSON-строк, по одной на группу
+    """
+    lines = []
+    for n, entries in enumerate(groups):
+        review = entries[0][3]
+        prompt = build_review_prompt(review.get("text", ""), review.get("gender", ""))
+        lines.append(json.dumps({
+            "custom_id": f"review-{n}",
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": {
+                "model": model,
+                "messages": [{"role": "user", "content": prompt}]
+            }
+        }, ensure_ascii=False))
+    return lines
+
+
+def submit_batch(client: OpenAI, lines: list):
+    """Загружает JSONL файл и создает пакетную задачу."""
+    payload = io.BytesIO(("\n".join(lines) + "\n").encode("utf-8"))
+    payload.name = "reviews_batch.jsonl"
+
+    batch_file = client.files.create(file=payload, purpose="batch")
+    return client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW
+    )
+
+
+def wait_for_batch(client: OpenAI, batch_id: str, poll_interval: int = 30, max_wait: int = BATCH_MAX_WAIT):
+    """
+    Ожидает завершения пакетной задачи, опрашивая статус с интервалом poll_interval секунд.
+
+    Если пакет не завершился за max_wait секунд, он отменяется, чтобы не блокировать
+    цикл пайплайна на все окно обработки (24 часа).
+
+    Raises:
+        TimeoutError: Если пакет не завершился за max_wait секунд
+    """
+    deadline = time.monotonic() + max_wait
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in BATCH_FINAL_STATUSES:
+            return batch
+        if time.monotonic() >= deadline:
+            client.batches.cancel(batch_id)
+            raise TimeoutError(f"Пакет {batch_id} не завершился за {max_wait}с и отменен")
+        logger.info(f"Пакет {batch_id}: статус {batch.status}, проверка через {poll_interval}с")
+        time.sleep(min(poll_interval, max(0.0, deadline - time.monotonic())))
+
+
+def _batch_cost(usage: dict, model_pricing: dict) -> float:
+    """Рассчитывает стоимость одного ответа с учетом скидки Batch API."""
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0
+    reasoning_tokens = (usage.get("completion_tokens_details") or {}).get("reasoning_tokens", 0) or 0
+
+    cost = (
+        (prompt_tokens - cached_tokens) / 1_000_000 * model_pricing.get("1M input tokens", 0)
+        + cached_tokens / 1_000_000 * model_pricing.get("1M cached** input tokens", 0)
+        + (completion_tokens + reasoning_tokens) / 1_000_000 * model_pricing.get("1M output tokens", 0)
+    )
+    return cost * BATCH_DISCOUNT
+
+
+def download_results(client: OpenAI, batch, model: str) -> dict:
+    """
+    Скачивает результаты пакета.
+
+    Returns:
+        Словарь custom_id -> {"content": str, "cost": float} для успешных ответов
+    """
+    with open(PRICING_PATH, "r", encoding="utf-8") as f:
+        model_pricing = json.load(f).get(model, {})
+
+    results = {}
+    if not batch.output_file_id:
+        return results
+
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        if item.get("error") or response.get("status_code") != 200:
+            logger.warning(f"Ошибка в ответе пакета для {item.get('custom_id')}: {item.get('error')}")
+            continue
+        body = response["body"]
+        results[item["custom_id"]] = {
+            "content": clean_llm_content(body["choices"][0]["message"]["content"]),
+            "cost": _batch_cost(body.get("usage") or {}, model_pricing)
+        }
+    return results
+
+
+def process_all_reviews_batch(data: dict, model: str, poll_interval: int = 30, max_wait: int = BATCH_MAX_WAIT) -> dict:
+    """
+    Обрабатывает все отзывы одним пакетом через Batch API.
+
+    Args:
+        data: Структура данных из reviews_data.json
+        model: Модель OpenAI для обработки
+        poll_interval: Интервал опроса статуса пакета в секундах
+        max_wait: Максимальное время ожидания пакета в секундах
+
+    Returns:
+        Обновленная структура данных с обработанными отзывами. Если пакет истек
+        или отменен, записываются только полученные результаты
+
+    Raises:
+        TimeoutError: Если пакет не завершился за max_wait секунд (пакет отменяется)
+        Exception: Если пакет завершился со статусом failed
+    """
+    if not supports_batch(model):
+        raise Exception(f"Модель {model} не поддерживает Batch API")
+
+    logger.info("="*60)
+    logger.info("Начинаем пакетную обработку отзывов")
+    logger.info(f"Модель: {model}")
+    logger.info("="*60)
+
+    # Группируем одинаковые отзывы, пустые не отправляем
+    groups = {}
+    for sheet_name, worksheets in data.items():
+        for worksheet_name, reviews in worksheets.items():
+            for i, review in enumerate(reviews):
+                if not review.get("text", ""):
+                    continue
+                key = (review.get("text", ""), review.get("gender", ""))
+                groups.setdefault(key, []).append((sheet_name, worksheet_name, i, review))
+    groups = list(groups.values())
+
+    if not groups:
+        logger.info("Нет отзывов для обработки")
+        return data
+
+    load_dotenv()
+    client = OpenAI()
+
+    start_time = datetime.now()
+    batch = submit_batch(client, build_batch_lines(groups, model))
+    logger.info(f"Создан пакет {batch.id} на {len(groups)} запросов")
+
+    batch = wait_for_batch(client, batch.id, poll_interval, max_wait)
+    if batch.status == "failed":
+        raise Exception(f"Пакет {batch.id} завершился с ошибкой: {batch.errors}")
+    if batch.status != "completed":
+        logger.error(f"Пакет {batch.id} завершился со статусом {batch.status}, "
+                     f"записываются только полученные результаты")
+    results = download_results(client, batch, model)
+
+    # Записываем результаты; дубликаты получают тот же ответ без повторной оплаты
+    stamp = datetime.now().isoformat()
+    processed = 0
+    for n, entries in enumerate(groups):
+        result = results.get(f"review-{n}")
+        if result is None:
+            continue
+        for j, (sheet_name, worksheet_name, index, review) in enumerate(entries):
+            apply_check_result(review, result if j == 0 else {**result, "cost": 0.0}, sheet_name, worksheet_name, stamp)
+            processed += 1
+
+    duration = (datetime.now() - start_time).total_seconds()
+    # Учитываются только ответы этого пакета, а не стоимость, уже записанная в data
+    total_cost = sum(result["cost"] for result in results.values())
+
+    logger.info("="*60)
+    logger.info("[OK] Пакетная обработка завершена!")
+    logger.info(f"Время выполнения: {duration:.2f} секунд")
+    logger.info(f"Обработано отзывов: {processed}")
+    logger.info(f"Общая стоимость: ${total_cost:.6f}")
+    logger.info("="*60)
+
+    return data
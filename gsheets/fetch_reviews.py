@@ -1,8 +1,16 @@
+import asyncio
 import json
 import os
 import sys
-import gspread
-from google.oauth2.service_account import Credentials
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from operator import itemgetter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Добавляем корневую директорию в путь для импорта logger_config
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -10,70 +18,399 @@ from logger_config import get_fetch_logger
 
 logger = get_fetch_logger()
 
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+CREDENTIALS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "credentials.json")
+SPREADSHEET_URL = "https://sheets.googleapis.com/v4/spreadsheets/{}"
+VALUES_BATCH_GET_URL = SPREADSHEET_URL + "/values:batchGet"
+
+SHEETS_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sheets_config.json")
+
+# Варианты названий колонок -> поле
+_VARIANT_TO_FIELD = (
+    {v: "text" for v in ("Исходный текст", "text", "текст")}
+    | {v: "gender" for v in ("Пол", "gender", "пол")}
+    | {v: "corrected" for v in ("Текст после правок", "corrected_text", "исправленный_текст", "исправленный текст")}
+    | {v: "status" for v in ("Статус", "status", "статус")}
+)
+_REQUIRED_FIELDS = frozenset(("text", "gender", "corrected"))
+
+# Клиенты gspread по потокам: requests.Session не гарантирует потокобезопасность
+_thread_local = threading.local()
+
+
+@lru_cache(maxsize=1)
+def _imports():
+    """
+    Лениво импортирует gspread, google-auth и requests.
+    
+    Эти библиотеки тянут большое дерево зависимостей, а модуль часто
+    импортируется только ради get_sheet_data_with_indices или записи JSON.
+    """
+    import gspread
+    from google.oauth2.service_account import Credentials
+    from requests.adapters import HTTPAdapter
+    return gspread, Credentials, HTTPAdapter
+
+
+def authorize_client(creds):
+    """
+    Создает клиент gspread с пулом соединений и HTTP keep-alive.
+    
+    Args:
+        creds: Учетные данные сервисного аккаунта
+        
+    Returns:
+        Авторизованный клиент gspread
+    """
+    gspread, _, HTTPAdapter = _imports()
+    client = gspread.authorize(creds)
+    
+    # gspread>=6 хранит сессию в http_client, более ранние версии - в самом клиенте
+    http_client = getattr(client, "http_client", client)
+    session = http_client.session
+    
+    # Монтируем адаптер в существующую AuthorizedSession, чтобы не потерять авторизацию
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=3)
+    session.mount("https://", adapter)
+    session.headers["Connection"] = "keep-alive"
+    
+    return client
+
+
+@lru_cache(maxsize=1)
+def _load_creds(mtime: float):
+    """
+    Загружает учетные данные сервисного аккаунта.
+    
+    Кэшируется по времени изменения файла: пока credentials.json не заменен,
+    повторно JSON и ключ не разбираются. Токен обновляется библиотекой
+    google-auth автоматически по истечении срока.
+    """
+    _, Credentials, _ = _imports()
+    return Credentials.from_service_account_file(CREDENTIALS_PATH, scopes=SCOPES)
+
+
+def _get_creds():
+    """Возвращает учетные данные, перечитывая файл только после его изменения."""
+    return _load_creds(os.stat(CREDENTIALS_PATH).st_mtime)
+
 
-def get_sheet_data_with_indices(worksheet):
+def _get_client():
+    """Возвращает клиент gspread текущего потока, создавая его при первом обращении."""
+    client = getattr(_thread_local, "client", None)
+    if client is None:
+        client = authorize_client(_get_creds())
+        _thread_local.client = client
+    return client
+
+
+def get_sheet_data_with_indices(all_values: list):
     """
-    Получает данные листа и индексы колонок.
+    Определяет индексы колонок по уже загруженным данным листа.
     
     Args:
-        worksheet: Объект worksheet из gspread
+        all_values: Все значения листа (список строк), первая строка - заголовки
         
     Returns:
         Кортеж (all_values, text_idx, gender_idx, corrected_idx, status_idx) или None при ошибке
         status_idx может быть None, если колонка "Статус" не найдена
     """
-    all_values = worksheet.get_all_values()
-    
     if not all_values:
         return None
     
-    headers = all_values[0]
-    
-    # Варианты названий колонок
-    text_variants = ["Исходный текст", "text", "текст"]
-    gender_variants = ["Пол", "gender", "пол"]
-    corrected_variants = ["Текст после правок", "corrected_text", "исправленный_текст", "исправленный текст"]
-    status_variants = ["Статус", "status", "статус"]
-    
-    # Нормализуем заголовки (убираем пробелы)
-    normalized_headers = [h.strip() for h in headers]
-    
-    # Ищем колонку с текстом
-    text_idx = None
-    for variant in text_variants:
-        if variant in normalized_headers:
-            text_idx = normalized_headers.index(variant)
-            break
-    
-    # Ищем колонку с полом
-    gender_idx = None
-    for variant in gender_variants:
-        if variant in normalized_headers:
-            gender_idx = normalized_headers.index(variant)
-            break
-    
-    # Ищем колонку с исправленным текстом
-    corrected_idx = None
-    for variant in corrected_variants:
-        if variant in normalized_headers:
-            corrected_idx = normalized_headers.index(variant)
-            break
-    
-    # Ищем колонку со статусом (опционально)
-    status_idx = None
-    for variant in status_variants:
-        if variant in normalized_headers:
-            status_idx = normalized_headers.index(variant)
-            break
+    # Один проход по заголовкам: для каждого поля берем первую подходящую колонку
+    found = {}
+    for i, header in enumerate(all_values[0]):
+        field = _VARIANT_TO_FIELD.get(header.strip())
+        if field and field not in found:
+            found[field] = i
     
     # Проверяем, что нашли все обязательные колонки
-    if text_idx is None or gender_idx is None or corrected_idx is None:
+    if not _REQUIRED_FIELDS <= found.keys():
         return None
     
-    return all_values, text_idx, gender_idx, corrected_idx, status_idx
+    # Колонка со статусом опциональна
+    return all_values, found["text"], found["gender"], found["corrected"], found.get("status")
+
+
+def quote_sheet_title(title: str) -> str:
+    """Экранирует название листа для использования в A1-нотации."""
+    return "'" + title.replace("'", "''") + "'"
 
 
-def fetch_reviews_from_sheets() -> dict:
+@lru_cache(maxsize=None)
+def column_letter(col_idx: int) -> str:
+    """Возвращает буквенное обозначение колонки по индексу с нуля (0 -> "A")."""
+    gspread, _, _ = _imports()
+    return gspread.utils.rowcol_to_a1(1, col_idx + 1)[:-1]
+
+
+def _api_get(client, url: str, params: dict) -> dict:
+    """
+    Выполняет GET-запрос к Sheets API через HTTP-сессию клиента gspread.
+    
+    gspread>=6 хранит запросы в http_client, более ранние версии - в самом клиенте.
+    """
+    http_client = getattr(client, "http_client", client)
+    return http_client.request("get", url, params=params).json()
+
+
+def get_sheet_titles(client, sheet_id: str) -> list:
+    """
+    Возвращает названия листов таблицы одним запросом spreadsheets.get.
+    
+    В отличие от open_by_key() + worksheets(), запрашивает только названия листов
+    и не создает объекты Spreadsheet/Worksheet.
+    """
+    metadata = _api_get(client, SPREADSHEET_URL.format(sheet_id), {"fields": "sheets.properties.title"})
+    return [sheet["properties"]["title"] for sheet in metadata.get("sheets", [])]
+
+
+def _values_batch_get(client, sheet_id: str, ranges: list, major_dimension: str) -> list:
+    """Выполняет values:batchGet и возвращает список valueRanges."""
+    response = _api_get(
+        client,
+        VALUES_BATCH_GET_URL.format(sheet_id),
+        {"ranges": ranges, "majorDimension": major_dimension}
+    )
+    return response.get("valueRanges", [])
+
+
+def batch_get_sheet_values(client, sheet_id: str) -> dict:
+    """
+    Загружает из всех листов таблицы только нужные колонки.
+    
+    Сначала одним запросом values:batchGet читаются заголовки всех листов,
+    затем вторым запросом - только колонки с текстом, полом и исправленным текстом.
+    Для широких листов это заметно уменьшает объем передаваемых данных.
+    Вместе с запросом названий листов на таблицу уходит три запроса.
+    
+    Args:
+        client: Авторизованный клиент gspread
+        sheet_id: ID Google таблицы
+        
+    Returns:
+        Словарь {название листа: значения листа}. Значения содержат только нужные
+        колонки (с заголовками в первой строке); для листов без нужных колонок
+        возвращается только строка заголовков
+    """
+    titles = get_sheet_titles(client, sheet_id)
+    if not titles:
+        return {}
+    
+    # Шаг 1: заголовки всех листов.
+    # valueRanges возвращаются в том же порядке, что и запрошенные диапазоны
+    value_ranges = _values_batch_get(
+        client, sheet_id, [f"{quote_sheet_title(title)}!1:1" for title in titles], "ROWS"
+    )
+    sheet_values = {}
+    layout = []
+    ranges = []
+    for title, value_range in zip(titles, value_ranges):
+        headers = (value_range.get("values") or [[]])[0]
+        sheet_values[title] = [headers]
+        
+        indices = get_sheet_data_with_indices([headers])
+        if indices is None:
+            continue
+        
+        _, text_idx, gender_idx, corrected_idx, _ = indices
+        columns = [column_letter(idx) for idx in (text_idx, gender_idx, corrected_idx)]
+        layout.append(title)
+        ranges.extend(f"{quote_sheet_title(title)}!{col}:{col}" for col in columns)
+    
+    if not ranges:
+        return sheet_values
+    
+    # Шаг 2: только нужные колонки, по три диапазона на лист
+    value_ranges = _values_batch_get(client, sheet_id, ranges, "COLUMNS")
+    for number, title in enumerate(layout):
+        columns = [
+            (value_range.get("values") or [[]])[0]
+            for value_range in value_ranges[number * 3:number * 3 + 3]
+        ]
+        # API обрезает пустые ячейки в конце колонок, выравниваем их по высоте
+        height = max((len(column) for column in columns), default=0)
+        padded = [column + [""] * (height - len(column)) for column in columns]
+        sheet_values[title] = [list(row) for row in zip(*padded)]
+    
+    return sheet_values
+
+
+def _rows_wide_enough(all_values: list, max_idx: int) -> list:
+    """
+    Возвращает строки данных (без заголовка), в которых есть колонка max_idx.
+    
+    Данные из batch_get_sheet_values прямоугольные, поэтому ширина проверяется
+    один раз через min(map(len, ...)) на уровне C, и только если встретились
+    короткие строки, они отфильтровываются поштучно.
+    """
+    rows = all_values[1:]
+    if min(map(len, rows), default=max_idx + 1) > max_idx:
+        return rows
+    return [row for row in rows if len(row) > max_idx]
+
+
+def _extract_reviews(all_values: list, text_idx: int, gender_idx: int, corrected_idx: int) -> list:
+    """
+    Отбирает записи с заполненным text и пустым corrected_text.
+    
+    Строки короче нужной ширины пропускаются. Пустота проверяется через
+    isspace() до strip(), чтобы не создавать строки для отброшенных записей;
+    первым проверяется corrected_text как самый частый повод отбросить строку.
+    
+    Args:
+        all_values: Все значения листа, первая строка - заголовки
+        text_idx: Индекс колонки с текстом
+        gender_idx: Индекс колонки с полом
+        corrected_idx: Индекс колонки с исправленным текстом
+        
+    Returns:
+        Список словарей {"text", "gender", "corrected_text"}
+    """
+    rows = _rows_wide_enough(all_values, max(text_idx, gender_idx, corrected_idx))
+    # itemgetter достает три ячейки строки одним C-вызовом вместо трех индексаций
+    pick = itemgetter(text_idx, gender_idx, corrected_idx)
+    intern = sys.intern
+    return [
+        {
+            "text": text.strip(),
+            # Пол из маленького алфавита (М/Ж/Н): интернируем, чтобы не хранить копию на каждую строку
+            "gender": intern(gender.strip()),  # Может быть пустым
+            "corrected_text": ""
+        }
+        for text, gender, corrected in map(pick, rows)
+        # Сначала corrected_text: в зрелой таблице большинство строк уже исправлены
+        if (not corrected or corrected.isspace())
+        and text and not text.isspace()
+    ]
+
+
+def _extract_columns(all_values: list, text_idx: int, gender_idx: int, corrected_idx: int) -> dict:
+    """
+    То же, что _extract_reviews, но в колоночном виде:
+    {"text": [...], "gender": [...], "corrected_text": [...]}.
+    
+    Три списка строк занимают заметно меньше памяти, чем словарь на каждую запись.
+    """
+    rows = _rows_wide_enough(all_values, max(text_idx, gender_idx, corrected_idx))
+    pick = itemgetter(text_idx, gender_idx, corrected_idx)
+    texts = []
+    genders = []
+    for text, gender, corrected in map(pick, rows):
+        # Сначала corrected_text: в зрелой таблице большинство строк уже исправлены
+        if corrected and not corrected.isspace():
+            continue
+        if not text or text.isspace():
+            continue
+        texts.append(text.strip())
+        genders.append(sys.intern(gender.strip()))
+    
+    return {"text": texts, "gender": genders, "corrected_text": [""] * len(texts)}
+
+
+def columns_to_reviews(columns: dict) -> list:
+    """Преобразует колоночное представление листа обратно в список записей."""
+    return [
+        {"text": t, "gender": g, "corrected_text": c}
+        for t, g, c in zip(columns["text"], columns["gender"], columns["corrected_text"])
+    ]
+
+
+def _fetch_one(sheet_name: str, sheet_id: str, columnar: bool = False) -> tuple:
+    """
+    Загружает отзывы из одной таблицы. Выполняется в отдельном потоке.
+    
+    Args:
+        sheet_name: Название таблицы из конфига
+        sheet_id: ID Google таблицы
+        columnar: Возвращать листы в колоночном виде (см. _extract_columns)
+        
+    Returns:
+        Кортеж (sheet_name, {название листа: список отзывов})
+    """
+    sheet_reviews = {}
+    # Статистика по листам: (название листа, количество записей).
+    # Логируется одной строкой на таблицу, а не двумя строками на каждый лист
+    per_sheet_stats = []
+    
+    try:
+        # Отдельный клиент на поток с общими учетными данными
+        client = _get_client()
+        
+        # Загружаем нужные колонки всех листов таблицы
+        sheet_values = batch_get_sheet_values(client, sheet_id)
+        
+        # Обрабатываем все листы в таблице
+        for worksheet_title, worksheet_values in sheet_values.items():
+            # Получаем индексы колонок через общую функцию
+            result = get_sheet_data_with_indices(worksheet_values)
+            
+            if result is None:
+                logger.warning("Не найдены нужные колонки в листе %s/%s", sheet_name, worksheet_title)
+                continue
+            
+            all_values, text_idx, gender_idx, corrected_idx, status_idx = result
+            
+            # Собираем записи
+            if columnar:
+                reviews = _extract_columns(all_values, text_idx, gender_idx, corrected_idx)
+                count = len(reviews["text"])
+            else:
+                reviews = _extract_reviews(all_values, text_idx, gender_idx, corrected_idx)
+                count = len(reviews)
+            
+            if count:
+                sheet_reviews[worksheet_title] = reviews
+            per_sheet_stats.append((worksheet_title, count))
+        
+        logger.info("Таблица %s: найдено записей по листам %s", sheet_name, per_sheet_stats)
+    
+    except Exception as e:
+        logger.error("Ошибка при обработке таблицы %s: %s", sheet_name, e, exc_info=True)
+    
+    return sheet_name, sheet_reviews
+
+
+@lru_cache(maxsize=1)
+def _read_sheets_config(mtime: float) -> dict:
+    """Читает конфигурацию с ID таблиц (кэшируется по времени изменения файла)."""
+    return read_json(SHEETS_CONFIG_PATH)
+
+
+def _load_sheets_config() -> dict:
+    """Загружает конфигурацию с ID таблиц, перечитывая файл только после его изменения."""
+    return _read_sheets_config(os.stat(SHEETS_CONFIG_PATH).st_mtime)
+
+
+def iter_sheet_reviews(max_workers: int = 8, columnar: bool = False):
+    """
+    Загружает таблицы из конфига параллельно и отдает их по мере готовности.
+    
+    Yields:
+        Кортежи (sheet_name, {название листа: список отзывов}) в порядке завершения загрузки
+    """
+    sheets_config = _load_sheets_config()
+    
+    # Загружаем учетные данные заранее: ошибка авторизации должна прервать загрузку,
+    # а не логироваться отдельно для каждой таблицы
+    _get_creds()
+    
+    # Обрабатываем таблицы из конфига параллельно: работа ограничена сетью, а не CPU.
+    # Список futures не сохраняем, чтобы as_completed отпускал уже отданные результаты
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in as_completed([
+            executor.submit(_fetch_one, sheet_name, sheet_id, columnar)
+            for sheet_name, sheet_id in sheets_config.items()
+        ]):
+            yield future.result()
+
+
+def fetch_reviews_from_sheets(max_workers: int = 10, columnar: bool = False) -> dict:
     """
     Читает данные из Google Sheets и возвращает структуру:
     {
@@ -89,79 +426,145 @@ def fetch_reviews_from_sheets() -> dict:
     Берет только те записи, где:
     - поле "text" заполнено
     - поле "corrected_text" пустое
+    
+    Синхронная обертка над fetch_reviews_async(): одновременно загружается
+    не более max_workers таблиц. Из работающего цикла событий нужно вызывать
+    fetch_reviews_async() напрямую.
+    
+    При columnar=True каждый лист возвращается в колоночном виде
+    {"text": [...], "gender": [...], "corrected_text": [...]}, что экономит память
+    на больших таблицах. Записи восстанавливаются через columns_to_reviews().
     """
-    # Определяем пути к файлам
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    credentials_path = os.path.join(current_dir, "credentials.json")
-    config_path = os.path.join(current_dir, "sheets_config.json")
+    return asyncio.run(fetch_reviews_async(max_workers, columnar))
+
+
+async def fetch_reviews_async(max_concurrent: int = 10, columnar: bool = False) -> dict:
+    """
+    Асинхронный вариант fetch_reviews_from_sheets() для вызова из event loop.
     
-    # Загружаем конфигурацию с ID таблиц
-    with open(config_path, "r", encoding="utf-8") as f:
-        sheets_config = json.load(f)
+    Таблицы загружаются через asyncio.gather, одновременно не более max_concurrent,
+    чтобы не превышать квоту Google на запросы от одного пользователя.
+    Каждая таблица обрабатывается в отдельном потоке со своим клиентом gspread.
+    Порядок таблиц в результате - как в конфиге.
+    """
+    sheets_config = _load_sheets_config()
     
-    # Настраиваем авторизацию Google Sheets API
-    scopes = [
-        'https://www.googleapis.com/auth/spreadsheets',
-        'https://www.googleapis.com/auth/drive'
-    ]
-    creds = Credentials.from_service_account_file(credentials_path, scopes=scopes)
-    client = gspread.authorize(creds)
+    # Ошибка авторизации должна прервать загрузку целиком
+    await asyncio.to_thread(_get_creds)
     
-    # Результирующая структура
-    all_reviews = {}
+    semaphore = asyncio.Semaphore(max_concurrent)
     
-    # Обрабатываем каждую таблицу из конфига
-    for sheet_name, sheet_id in sheets_config.items():
-        logger.info(f"Обработка таблицы: {sheet_name}")
-        all_reviews[sheet_name] = {}
-        
-        try:
-            # Открываем таблицу по ID
-            spreadsheet = client.open_by_key(sheet_id)
-            
-            # Обрабатываем все листы в таблице
-            for worksheet in spreadsheet.worksheets():
-                worksheet_title = worksheet.title
-                logger.info(f"  Обработка листа: {worksheet_title}")
-                
-                # Получаем данные листа и индексы колонок через общую функцию
-                result = get_sheet_data_with_indices(worksheet)
-                
-                if result is None:
-                    logger.warning(f"    Не найдены нужные колонки в листе {worksheet_title}")
-                    continue
-                
-                all_values, text_idx, gender_idx, corrected_idx, status_idx = result
-                
-                # Собираем записи
-                reviews = []
-                for row in all_values[1:]:  # Пропускаем заголовок
-                    # Проверяем, что строка достаточно длинная
-                    if len(row) <= max(text_idx, gender_idx, corrected_idx):
-                        continue
-                    
-                    text = row[text_idx].strip() if text_idx < len(row) else ""
-                    gender = row[gender_idx].strip() if gender_idx < len(row) else ""
-                    corrected = row[corrected_idx].strip() if corrected_idx < len(row) else ""
-                    
-                    # Берем только записи с заполненным text и пустым corrected_text
-                    if text and not corrected:
-                        reviews.append({
-                            "text": text,
-                            "gender": gender,  # Может быть пустым
-                            "corrected_text": ""
-                        })
-                
-                if reviews:
-                    all_reviews[sheet_name][worksheet_title] = reviews
-                    logger.info(f"    Найдено записей: {len(reviews)}")
-                else:
-                    logger.info(f"    Нет подходящих записей")
-        
-        except Exception as e:
-            logger.error(f"Ошибка при обработке таблицы {sheet_name}: {e}", exc_info=True)
+    async def fetch_with_semaphore(sheet_name, sheet_id):
+        async with semaphore:
+            return await asyncio.to_thread(_fetch_one, sheet_name, sheet_id, columnar)
+    
+    results = await asyncio.gather(*[
+        fetch_with_semaphore(sheet_name, sheet_id)
+        for sheet_name, sheet_id in sheets_config.items()
+    ])
+    
+    return dict(results)
+
+
+def _dumps(data, indent: int = None) -> str:
+    """
+    Сериализует значение в JSON-строку: компактную или, если задан indent,
+    с отступами по 2 пробела, сдвинутую на indent пробелов для вложения в документ.
+    """
+    if indent is None:
+        if orjson is not None:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
     
-    return all_reviews
+    if orjson is not None:
+        text = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2).decode("utf-8")
+    else:
+        text = json.dumps(data, ensure_ascii=False, indent=2)
+    return text.replace("\n", "\n" + " " * indent)
+
+
+def read_json(path: str):
+    """Читает JSON файл (через orjson, если он установлен)."""
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_json(data: dict, output_path: str):
+    """
+    Записывает данные в JSON файл (через orjson, если он установлен).
+    
+    По умолчанию пишет компактный JSON; читаемый вывод с отступами
+    включается переменной окружения PRETTY_JSON.
+    """
+    pretty = bool(os.environ.get("PRETTY_JSON"))
+    
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        with open(output_path, "wb") as f:
+            f.write(orjson.dumps(data, option=option))
+    else:
+        with open(output_path, "w", encoding="utf-8") as f:
+            if pretty:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            else:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+
+
+def stream_reviews_to_json(output_path: str, max_workers: int = 8) -> dict:
+    """
+    Загружает отзывы и пишет их в JSON файл по мере загрузки таблиц.
+    
+    Структура файла та же, что у fetch_reviews_from_sheets(), но в памяти
+    одновременно находится только одна таблица, а не все данные сразу. Поэтому
+    таблицы записываются в порядке завершения загрузки, и он может меняться между запусками.
+    
+    Данные пишутся во временный файл рядом с output_path, который заменяет output_path
+    только после успешной загрузки всех таблиц: при ошибке прежний файл остается целым.
+    Формат (компактный или с отступами по PRETTY_JSON) тот же, что у write_json().
+    
+    Returns:
+        Словарь {название таблицы: количество записей}
+    """
+    counts = {}
+    tmp_path = output_path + ".tmp"
+    
+    # Разметка с отступами повторяет json.dump(indent=2) / orjson.OPT_INDENT_2
+    pretty = bool(os.environ.get("PRETTY_JSON"))
+    colon = ": " if pretty else ":"
+    sheet_indent = "\n  " if pretty else ""
+    worksheet_indent = "\n    " if pretty else ""
+    
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("{")
+            for sheet_number, (sheet_name, sheet_reviews) in enumerate(iter_sheet_reviews(max_workers)):
+                if sheet_number:
+                    f.write(",")
+                f.write(sheet_indent + _dumps(sheet_name) + colon + "{")
+                for worksheet_number, (worksheet_title, reviews) in enumerate(sheet_reviews.items()):
+                    if worksheet_number:
+                        f.write(",")
+                    f.write(worksheet_indent + _dumps(worksheet_title) + colon
+                            + _dumps(reviews, 4 if pretty else None))
+                if sheet_reviews:
+                    f.write(sheet_indent)
+                f.write("}")
+                counts[sheet_name] = sum(len(reviews) for reviews in sheet_reviews.values())
+            if pretty and counts:
+                f.write("\n")
+            f.write("}")
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    return counts
 
 
 def save_reviews_to_json(reviews: dict, output_file: str = "reviews_data.json"):
@@ -171,8 +574,7 @@ def save_reviews_to_json(reviews: dict, output_file: str = "reviews_data.json"):
     current_dir = os.path.dirname(os.path.abspath(__file__))
     output_path = os.path.join(current_dir, output_file)
     
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(reviews, f, ensure_ascii=False, indent=2)
+    write_json(reviews, output_path)
     
     logger.info(f"Данные сохранены в: {output_path}")
     return output_path
@@ -181,9 +583,6 @@ def save_reviews_to_json(reviews: dict, output_file: str = "reviews_data.json"):
 if __name__ == "__main__":
     logger.info("Начинаем загрузку данных из Google Sheets")
     
-    # Загружаем данные
-    reviews = fetch_reviews_from_sheets()
-    
     # Сохраняем в папку test_data
     current_dir = os.path.dirname(os.path.abspath(__file__))
     test_data_dir = os.path.join(current_dir, "test_data")
@@ -194,18 +593,15 @@ if __name__ == "__main__":
     # Путь к файлу с данными
     output_file_path = os.path.join(test_data_dir, "reviews_data.json")
     
-    # Сохраняем JSON
-    with open(output_file_path, "w", encoding="utf-8") as f:
-        json.dump(reviews, f, ensure_ascii=False, indent=2)
+    # Загружаем данные и сразу пишем их в JSON по мере загрузки таблиц
+    counts = stream_reviews_to_json(output_file_path)
     
     logger.info(f"Данные сохранены в: {output_file_path}")
     
     # Выводим статистику
     logger.info("=== Статистика ===")
     total_reviews = 0
-    for sheet_name, worksheets in reviews.items():
-        sheet_total = sum(len(records) for records in worksheets.values())
+    for sheet_name, sheet_total in counts.items():
         total_reviews += sheet_total
         logger.info(f"{sheet_name}: {sheet_total} записей")
     logger.info(f"Всего записей: {total_reviews}")
-
@@ -1,11 +1,18 @@
-import json
 import os
 import sys
 import re
-import difflib
+import bisect
+from operator import itemgetter
 import gspread
 from google.oauth2.service_account import Credentials
-from .fetch_reviews import get_sheet_data_with_indices
+
+# C-реализация SequenceMatcher (тот же алгоритм и результат), если установлена
+try:
+    from cdifflib import CSequenceMatcher as SequenceMatcher
+except ImportError:
+    from difflib import SequenceMatcher
+
+from .fetch_reviews import SCOPES, authorize_client, get_sheet_data_with_indices, read_json
 
 # Добавляем корневую директорию в путь для импорта logger_config
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -17,6 +24,17 @@ logger = get_update_logger()
 # Константы для форматирования
 RED_COLOR = {"red": 1.0, "green": 0.0, "blue": 0.0}
 GREEN_COLOR = {"red": 0.0, "green": 0.6, "blue": 0.0}
+BLACK_COLOR = {"red": 0.0, "green": 0.0, "blue": 0.0}
+
+# Типы цветных зон: сравниваются как int, цвет подставляется при формировании runs
+_RED_ZONE = 0
+_GREEN_ZONE = 1
+_ZONE_COLORS = (RED_COLOR, GREEN_COLOR)
+
+# Разметка орфографических ошибок вида [[...]]
+_MARKUP_RE = re.compile(r'\[\[(.*?)\]\]')
+# Токены: слова без пробельных промежутков
+_TOKEN_RE = re.compile(r'\S+')
 
 
 def parse_marked_text(text: str):
@@ -33,9 +51,7 @@ def parse_marked_text(text: str):
     current_pos = 0
     
     # Ищем все вхождения [[...]]
-    pattern = r'\[\[(.*?)\]\]'
-    
-    for match in re.finditer(pattern, text):
+    for match in _MARKUP_RE.finditer(text):
         # Добавляем текст до ошибки
         if match.start() > current_pos:
             segments.append({
@@ -74,40 +90,28 @@ def find_text_differences(original: str, corrected_with_markup: str):
         Список кортежей (start_idx, end_idx) для зеленого форматирования
     """
     # Убираем разметку [[]] из corrected для сравнения
-    clean_corrected = re.sub(r'\[\[(.*?)\]\]', r'\1', corrected_with_markup)
+    if "[[" in corrected_with_markup:
+        clean_corrected = _MARKUP_RE.sub(r'\1', corrected_with_markup)
+    else:
+        clean_corrected = corrected_with_markup
     
     # Если тексты одинаковые, нет различий
     if original == clean_corrected:
         return []
     
-    # Разбиваем на слова с сохранением позиций
-    def tokenize_with_positions(text):
-        """Возвращает список (слово, start_pos, end_pos)"""
-        tokens = []
-        current_pos = 0
-        for match in re.finditer(r'\S+|\s+', text):
-            word = match.group()
-            start = match.start()
-            end = match.end()
-            tokens.append((word, start, end))
-        return tokens
-    
-    original_tokens = tokenize_with_positions(original)
-    corrected_tokens = tokenize_with_positions(clean_corrected)
-    
     # Сравниваем только слова (без пробелов)
-    original_words = [t[0] for t in original_tokens if not t[0].isspace()]
-    corrected_words = [t[0] for t in corrected_tokens if not t[0].isspace()]
+    original_words = _TOKEN_RE.findall(original)
     
-    matcher = difflib.SequenceMatcher(None, original_words, corrected_words)
+    # Слова исправленного текста и их позиции в тексте
+    corrected_words = []
+    corrected_word_positions = []
+    for match in _TOKEN_RE.finditer(clean_corrected):
+        corrected_words.append(match.group())
+        corrected_word_positions.append(match.span())
     
-    differences = []
+    matcher = SequenceMatcher(None, original_words, corrected_words)
     
-    # Создаем маппинг индекса слова -> позиция в тексте
-    corrected_word_positions = []
-    for token, start, end in corrected_tokens:
-        if not token.isspace():
-            corrected_word_positions.append((start, end))
+    differences = []
     
     for tag, i1, i2, j1, j2 in matcher.get_opcodes():
         if tag in ('replace', 'insert'):
@@ -131,64 +135,82 @@ def create_rich_text_value(text: str, original_text: str = None):
     Returns:
         Кортеж (clean_text, runs) для textFormatRuns API
     """
-    segments = parse_marked_text(text)
-    
-    # Формируем чистый текст без разметки
-    clean_text = "".join(seg["text"] for seg in segments)
-    
-    # Создаем список всех форматированных зон: (start, end, color)
+    # Без разметки [[ ]] текст уже чистый: regex-разбор не нужен
+    if "[[" not in text:
+        if not original_text:
+            return text, []
+        segments = [{"text": text, "is_error": False}] if text else []
+    else:
+        segments = parse_marked_text(text)
+    
+    # Создаем список всех форматированных зон: (start, end, тип зоны)
     colored_zones = []
     
-    # Добавляем красные зоны для [[]] (орфографические ошибки)
+    # За один проход собираем чистый текст без разметки
+    # и красные зоны для [[]] (орфографические ошибки)
+    parts = []
     start_index = 0
     for segment in segments:
-        segment_length = len(segment["text"])
+        segment_text = segment["text"]
+        parts.append(segment_text)
+        segment_length = len(segment_text)
         if segment["is_error"]:
-            colored_zones.append((start_index, start_index + segment_length, RED_COLOR))
+            colored_zones.append((start_index, start_index + segment_length, _RED_ZONE))
         start_index += segment_length
+    clean_text = "".join(parts)
     
     # Если есть оригинальный текст, добавляем зеленые зоны для изменений
     if original_text:
         differences = find_text_differences(original_text, text)
         
-        # Создаем множество позиций с красным цветом
-        red_positions = set()
-        for start, end, color in colored_zones:
-            if color == RED_COLOR:
-                red_positions.update(range(start, end))
+        # Красные интервалы идут по порядку и не пересекаются (построены из сегментов),
+        # поэтому их концы тоже отсортированы. Пустые интервалы ничего не закрашивают
+        red_intervals = [(start, end) for start, end, kind in colored_zones if kind == _RED_ZONE and start < end]
+        red_starts = [start for start, _ in red_intervals]
         
         # Добавляем зеленые зоны, избегая красных
         for start_idx, end_idx in differences:
-            # Проверяем, не пересекается ли с красными зонами
-            has_red = any(i in red_positions for i in range(start_idx, min(end_idx, len(clean_text))))
+            # Проверяем, не пересекается ли с красными зонами: достаточно проверить
+            # последний красный интервал, начинающийся левее конца зеленой зоны
+            clipped_end = min(end_idx, len(clean_text))
+            i = bisect.bisect_left(red_starts, clipped_end)
+            has_red = start_idx < clipped_end and i > 0 and red_intervals[i - 1][1] > start_idx
             
             if not has_red and start_idx < len(clean_text):
-                colored_zones.append((start_idx, end_idx, GREEN_COLOR))
+                colored_zones.append((start_idx, end_idx, _GREEN_ZONE))
     
     # Преобразуем зоны в textFormatRuns
     # В Google Sheets API нужно указывать начало каждого форматирования
-    # И после каждой цветной зоны нужно "сбрасывать" формат
+    # И после цветной зоны нужно "сбрасывать" формат, если следующая зона не начинается сразу за ней
     runs = []
-    
-    # Сортируем зоны по началу
-    colored_zones.sort(key=lambda x: x[0])
-    
-    for start, end, color in colored_zones:
-        # Начало форматирования
-        runs.append({
-            "startIndex": start,
-            "format": {
-                "foregroundColor": color
-            }
-        })
-        # Конец форматирования - сброс на черный цвет
-        if end < len(clean_text):
+    text_length = len(clean_text)
+    
+    # Сортируем зоны по началу; пустые зоны ничего не закрашивают
+    colored_zones = sorted(
+        (zone for zone in colored_zones if zone[0] < zone[1]),
+        key=itemgetter(0)
+    )
+    
+    prev_end = prev_kind = None
+    for i, (start, end, kind) in enumerate(colored_zones):
+        # Начало форматирования; вплотную идущая зона того же цвета продолжает предыдущую
+        if not (kind == prev_kind and start == prev_end):
+            runs.append({
+                "startIndex": start,
+                "format": {
+                    "foregroundColor": _ZONE_COLORS[kind]
+                }
+            })
+        # Конец форматирования - сброс на черный цвет, если до следующей зоны есть промежуток
+        next_start = colored_zones[i + 1][0] if i + 1 < len(colored_zones) else text_length
+        if end < next_start:
             runs.append({
                 "startIndex": end,
                 "format": {
-                    "foregroundColor": {"red": 0.0, "green": 0.0, "blue": 0.0}
+                    "foregroundColor": BLACK_COLOR
                 }
             })
+        prev_end, prev_kind = end, kind
     
     return clean_text, runs
 
@@ -203,23 +225,59 @@ def authenticate_gspread(credentials_path: str):
     Returns:
         Авторизованный клиент gspread
     """
-    scopes = [
-        'https://www.googleapis.com/auth/spreadsheets',
-        'https://www.googleapis.com/auth/drive'
-    ]
-    
-    credentials = Credentials.from_service_account_file(credentials_path, scopes=scopes)
-    client = gspread.authorize(credentials)
+    credentials = Credentials.from_service_account_file(credentials_path, scopes=SCOPES)
+    client = authorize_client(credentials)
     
     return client
 
 
-def find_column_index(headers, possible_names):
-    """Находит индекс колонки по возможным названиям."""
-    for name in possible_names:
-        if name in headers:
-            return headers.index(name)
-    raise ValueError(f"Не найдена ни одна из колонок: {', '.join(possible_names)}")
+def build_update_cells_requests(worksheet_id: int, cells: list) -> list:
+    """
+    Группирует ячейки по колонкам и объединяет подряд идущие строки
+    в один запрос updateCells для spreadsheets.batchUpdate.
+    
+    Args:
+        worksheet_id: ID листа (sheetId)
+        cells: Список кортежей (индекс колонки с нуля, номер строки с единицы, значение)
+        
+    Returns:
+        Список запросов updateCells
+    """
+    by_column = {}
+    for col, row, value in cells:
+        by_column.setdefault(col, []).append((row, value))
+    
+    requests = []
+    
+    def add_request(col, first_row, last_row, rows):
+        requests.append({
+            "updateCells": {
+                "range": {
+                    "sheetId": worksheet_id,
+                    "startRowIndex": first_row - 1,
+                    "endRowIndex": last_row,
+                    "startColumnIndex": col,
+                    "endColumnIndex": col + 1
+                },
+                "rows": rows,
+                "fields": "userEnteredValue"
+            }
+        })
+    
+    for col, items in by_column.items():
+        items.sort(key=itemgetter(0))
+        run_start = prev_row = items[0][0]
+        rows = []
+        for row, value in items:
+            if rows and row != prev_row + 1:
+                add_request(col, run_start, prev_row, rows)
+                run_start = row
+                rows = []
+            rows.append({"values": [{"userEnteredValue": {"stringValue": value}}]})
+            prev_row = row
+        add_request(col, run_start, prev_row, rows)
+    
+    return requests
 
 
 def update_sheet_with_reviews(client, sheet_id: str, sheet_name: str, worksheet_name: str, reviews: list):
@@ -232,8 +290,11 @@ def update_sheet_with_reviews(client, sheet_id: str, sheet_name: str, worksheet_
         sheet_name: Название таблицы (для логирования)
         worksheet_name: Название листа
         reviews: Список отзывов для обновления
+        
+    Returns:
+        True, если лист обновлен (или обновлять было нечего), False при ошибке
     """
-    logger.info(f"  Обработка листа: {worksheet_name}")
+    logger.info("  Обработка листа: %s", worksheet_name)
     
     try:
         # Открываем таблицу и лист
@@ -241,48 +302,60 @@ def update_sheet_with_reviews(client, sheet_id: str, sheet_name: str, worksheet_
         worksheet = spreadsheet.worksheet(worksheet_name)
         
         # Получаем данные листа и индексы колонок через общую функцию из fetch_reviews
-        result = get_sheet_data_with_indices(worksheet)
+        result = get_sheet_data_with_indices(worksheet.get_all_values())
         
         if result is None:
-            logger.error(f"    Не найдены нужные колонки в листе {worksheet_name}")
-            return
+            logger.error("    Не найдены нужные колонки в листе %s", worksheet_name)
+            return False
         
         all_values, text_idx, gender_idx, corrected_idx, status_idx = result
         
         # Создаем словарь для быстрого поиска отзывов из JSON
         # Используем ТУ ЖЕ логику чтения текста, что и в fetch_reviews.py
-        reviews_dict = {}
-        for review in reviews:
-            # Берем текст точно так же, как в fetch_reviews.py
-            text = review.get("text", "").strip()
-            if text:
-                reviews_dict[text] = review
+        reviews_dict = {
+            text: review
+            for review in reviews
+            for text in (review.get("text", "").strip(),)
+            if text
+        }
+        # Длины ключей: строки другой длины отсеиваются без хеширования длинного текста
+        review_lengths = frozenset(map(len, reviews_dict))
         
         
         # Получаем ID листа для batch update
         worksheet_id = worksheet.id
         
-        # Собираем batch запросы
-        batch_updates = []
+        # Собираем batch запросы: значения ячеек (индекс колонки, строка, значение) и форматирование
+        value_cells = []
+        format_updates = []
         update_count = 0
         rows_checked = 0
         rows_matched = 0
         
         # Проходим по строкам (начиная со второй, т.к. первая - заголовки) 
         # ИСПОЛЬЗУЕМ ТУ ЖЕ ЛОГИКУ, что и в fetch_reviews.py
+        # Границы колонки исправленного текста постоянны для листа
+        corrected_range_cols = {
+            "sheetId": worksheet_id,
+            "startColumnIndex": corrected_idx,
+            "endColumnIndex": corrected_idx + 1
+        }
+        
+        # Минимальная длина строки постоянна для листа: считаем один раз
+        max_idx = max(text_idx, gender_idx, corrected_idx)
+        if status_idx is not None:
+            max_idx = max(max_idx, status_idx)
+        
         for row_idx, row in enumerate(all_values[1:], start=2):
             rows_checked += 1
             
             # Проверяем, что строка достаточно длинная
-            required_cols = [text_idx, gender_idx, corrected_idx]
-            if status_idx is not None:
-                required_cols.append(status_idx)
-            if len(row) <= max(required_cols):
+            if len(row) <= max_idx:
                 continue
             
             # Берем текст ТОЧНО ТАК ЖЕ, как в fetch_reviews.py
-            text = row[text_idx].strip() if text_idx < len(row) else ""
-            corrected = row[corrected_idx].strip() if corrected_idx < len(row) else ""
+            text = row[text_idx].strip()
+            corrected = row[corrected_idx].strip()
             
             if not text:
                 continue
@@ -291,6 +364,8 @@ def update_sheet_with_reviews(client, sheet_id: str, sheet_name: str, worksheet_
             # ТА ЖЕ ЛОГИКА, что и в fetch_reviews.py
             if not corrected:
                 # Ищем соответствующий отзыв из JSON
+                if len(text) not in review_lengths:
+                    continue
                 review = reviews_dict.get(text)
                 
                 if not review:
@@ -300,10 +375,7 @@ def update_sheet_with_reviews(client, sheet_id: str, sheet_name: str, worksheet_
                 
                 # Обновляем пол (всегда, если есть в review)
                 if review.get("gender"):
-                    batch_updates.append({
-                        "range": f"{gspread.utils.rowcol_to_a1(row_idx, gender_idx + 1)}",
-                        "values": [[review["gender"]]]
-                    })
+                    value_cells.append((gender_idx, row_idx, review["gender"]))
                 
                 # Обновляем исправленный текст с форматированием
                 if review.get("corrected_text"):
@@ -314,23 +386,17 @@ def update_sheet_with_reviews(client, sheet_id: str, sheet_name: str, worksheet_
                     # Передаем оригинальный текст для определения изменений (зеленый цвет)
                     clean_text, text_runs = create_rich_text_value(corrected_text, original_text=text)
                     
-                    # Добавляем запрос на обновление значения
-                    batch_updates.append({
-                        "range": f"{gspread.utils.rowcol_to_a1(row_idx, corrected_idx + 1)}",
-                        "values": [[clean_text]]
-                    })
-                    
-                    # Если есть форматирование, добавляем его через API
-                    if text_runs:
+                    # Если есть форматирование, repeatCell сам записывает значение ячейки
+                    if not text_runs:
+                        value_cells.append((corrected_idx, row_idx, clean_text))
+                    else:
                         # Формируем запрос для textFormat
                         cell_format_request = {
                             "repeatCell": {
                                 "range": {
-                                    "sheetId": worksheet_id,
+                                    **corrected_range_cols,
                                     "startRowIndex": row_idx - 1,
-                                    "endRowIndex": row_idx,
-                                    "startColumnIndex": corrected_idx,
-                                    "endColumnIndex": corrected_idx + 1
+                                    "endRowIndex": row_idx
                                 },
                                 "cell": {
                                     "userEnteredValue": {
@@ -341,42 +407,33 @@ def update_sheet_with_reviews(client, sheet_id: str, sheet_name: str, worksheet_
                                 "fields": "userEnteredValue,textFormatRuns"
                             }
                         }
-                        batch_updates.append(cell_format_request)
+                        format_updates.append(cell_format_request)
                     
                     # Обновляем статус, если колонка существует
                     if status_idx is not None:
-                        batch_updates.append({
-                            "range": f"{gspread.utils.rowcol_to_a1(row_idx, status_idx + 1)}",
-                            "values": [["Исправлен"]]
-                        })
+                        value_cells.append((status_idx, row_idx, "Исправлен"))
                     
                     update_count += 1
         
+        logger.debug("    Проверено строк: %s, отзывов для листа: %s", rows_checked, len(reviews_dict))
+        
         # Выполняем batch update
-        if batch_updates:
-            # Разделяем на value updates и format updates
-            value_updates = [u for u in batch_updates if "range" in u]
-            format_updates = [u for u in batch_updates if "repeatCell" in u]
+        if value_cells or format_updates:
+            # Значения и форматирование уходят одним запросом spreadsheets.batchUpdate;
+            # соседние строки одной колонки объединяются в один updateCells
+            requests = build_update_cells_requests(worksheet_id, value_cells) + format_updates
+            spreadsheet.batch_update({"requests": requests})
             
-            # Обновляем значения
-            if value_updates:
-                worksheet.batch_update([{
-                    "range": u["range"],
-                    "values": u["values"]
-                } for u in value_updates])
-            
-            # Обновляем форматирование
-            if format_updates:
-                spreadsheet.batch_update({"requests": format_updates})
-            
-            logger.info(f"    Обновлено строк: {update_count}")
+            logger.info("    Обновлено строк: %s", update_count)
         else:
-            logger.info(f"    Нет строк для обновления")
+            logger.info("    Нет строк для обновления")
+        return True
             
     except gspread.exceptions.WorksheetNotFound:
-        logger.error(f"    Лист '{worksheet_name}' не найден")
+        logger.error("    Лист '%s' не найден", worksheet_name)
     except Exception as e:
-        logger.error(f"    Ошибка при обработке листа '{worksheet_name}': {e}", exc_info=True)
+        logger.error("    Ошибка при обработке листа '%s': %s", worksheet_name, e, exc_info=True)
+    return False
 
 
 def update_all_sheets(reviews_data: dict, sheets_config_path: str, credentials_path: str):
@@ -387,14 +444,16 @@ def update_all_sheets(reviews_data: dict, sheets_config_path: str, credentials_p
         reviews_data: Данные из marked_reviews.json
         sheets_config_path: Путь к sheets_config.json
         credentials_path: Путь к credentials.json
+        
+    Returns:
+        True, если все листы обновлены без ошибок
     """
     logger.info("="*60)
     logger.info("ОБНОВЛЕНИЕ GOOGLE SHEETS")
     logger.info("="*60)
     
     # Загружаем конфигурацию таблиц
-    with open(sheets_config_path, "r", encoding="utf-8") as f:
-        sheets_config = json.load(f)
+    sheets_config = read_json(sheets_config_path)
     
     # Аутентификация
     logger.info("Аутентификация в Google Sheets...")
@@ -402,21 +461,28 @@ def update_all_sheets(reviews_data: dict, sheets_config_path: str, credentials_p
     logger.info("[OK] Аутентификация успешна")
     
     # Обрабатываем каждую таблицу
+    all_updated = True
     for sheet_name, sheet_id in sheets_config.items():
-        logger.info(f"Таблица: {sheet_name} (ID: {sheet_id})")
+        logger.info("Таблица: %s (ID: %s)", sheet_name, sheet_id)
         
         if sheet_name not in reviews_data:
-            logger.warning(f"  Нет данных для таблицы {sheet_name}")
+            logger.warning("  Нет данных для таблицы %s", sheet_name)
             continue
         
         worksheets_data = reviews_data[sheet_name]
         
         for worksheet_name, reviews in worksheets_data.items():
-            update_sheet_with_reviews(client, sheet_id, sheet_name, worksheet_name, reviews)
+            if not update_sheet_with_reviews(client, sheet_id, sheet_name, worksheet_name, reviews):
+                all_updated = False
     
     logger.info("="*60)
-    logger.info("[OK] ОБНОВЛЕНИЕ ЗАВЕРШЕНО")
+    if all_updated:
+        logger.info("[OK] ОБНОВЛЕНИЕ ЗАВЕРШЕНО")
+    else:
+        logger.warning("ОБНОВЛЕНИЕ ЗАВЕРШЕНО С ОШИБКАМИ")
     logger.info("="*60)
+    
+    return all_updated
 
 
 if __name__ == "__main__":
@@ -429,26 +495,25 @@ if __name__ == "__main__":
     
     # Проверяем наличие файлов
     if not os.path.exists(reviews_file):
-        logger.error(f"Файл {reviews_file} не найден")
+        logger.error("Файл %s не найден", reviews_file)
         exit(1)
     
     if not os.path.exists(sheets_config_file):
-        logger.error(f"Файл {sheets_config_file} не найден")
+        logger.error("Файл %s не найден", sheets_config_file)
         exit(1)
     
     if not os.path.exists(credentials_file):
-        logger.error(f"Файл {credentials_file} не найден")
+        logger.error("Файл %s не найден", credentials_file)
         logger.error("Создайте service account в Google Cloud Console и скачайте credentials.json")
         exit(1)
     
     # Загружаем данные отзывов
-    with open(reviews_file, "r", encoding="utf-8") as f:
-        reviews_data = json.load(f)
+    reviews_data = read_json(reviews_file)
     
-    logger.info(f"Загружено отзывов из {reviews_file}:")
+    logger.info("Загружено отзывов из %s:", reviews_file)
     for sheet_name, worksheets in reviews_data.items():
         for worksheet_name, reviews in worksheets.items():
-            logger.info(f"  - {sheet_name}/{worksheet_name}: {len(reviews)} отзывов")
+            logger.info("  - %s/%s: %s отзывов", sheet_name, worksheet_name, len(reviews))
     
     # Обновляем Google Sheets
     update_all_sheets(reviews_data, sheets_config_file, credentials_file)
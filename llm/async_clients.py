@@ -0,0 +1,81 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+from openai import AsyncOpenAI
+
+
+# Общие лимиты пула соединений для асинхронных клиентов
+_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=100)
+
+# name -> (event loop, клиент). Пул соединений httpx привязан к циклу событий,
+# поэтому для каждого нового asyncio.run создается свой клиент
+_clients = {}
+
+
+def get_async_openai(name: str, **kwargs) -> AsyncOpenAI:
+    """
+    Возвращает асинхронный OpenAI-совместимый клиент для текущего цикла событий.
+
+    :param name: Имя провайдера (ключ кэша клиентов)
+    :param kwargs: Параметры AsyncOpenAI (api_key, base_url)
+    """
+    loop = asyncio.get_running_loop()
+    entry = _clients.get(name)
+    if entry is None or entry[0] is not loop:
+        client = AsyncOpenAI(http_client=httpx.AsyncClient(limits=_LIMITS), **kwargs)
+        _clients[name] = (loop, client)
+        return client
+    return entry[1]
+
+
+# usage для потока, в котором провайдер не прислал финальный чанк с usage
+# (игнорирует stream_options.include_usage или поток оборвался): стоимость считается нулевой
+_ZERO_USAGE = SimpleNamespace(
+    prompt_tokens=0,
+    completion_tokens=0,
+    prompt_tokens_details=None,
+    completion_tokens_details=None,
+    prompt_cache_hit_tokens=0,
+    prompt_cache_miss_tokens=0,
+)
+
+
+class ResponseTooLongError(Exception):
+    """Ответ модели превысил допустимую длину и был прерван."""
+
+
+async def stream_completion(client: AsyncOpenAI, max_chars: int, **kwargs):
+    """
+    Выполняет chat.completions.create в потоковом режиме и прерывает ответ,
+    как только его длина превысит max_chars символов.
+
+    Возвращает объект с полями choices[0].message.content и usage, как у обычного
+    ответа, поэтому его можно передать в _build_response провайдера. Если чанк с usage
+    не пришел, usage заполняется нулями (_ZERO_USAGE), а полученный текст не теряется.
+
+    :raises ResponseTooLongError: Если ответ длиннее max_chars (соединение закрывается)
+    """
+    stream = await client.chat.completions.create(
+        stream=True,
+        stream_options={"include_usage": True},
+        **kwargs
+    )
+    parts = []
+    length = 0
+    usage = None
+    async for chunk in stream:
+        if chunk.usage is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            length += len(delta)
+            if length > max_chars:
+                await stream.close()
+                raise ResponseTooLongError(f"Ответ модели длиннее {max_chars} символов")
+
+    message = SimpleNamespace(content="".join(parts))
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage or _ZERO_USAGE)
@@ -2,19 +2,25 @@ import json
 import os
 import anthropic
 from dotenv import load_dotenv
-from llm_response_cleaner import clean_llm_content
+from .llm_response_cleaner import clean_llm_content
 
 
-def request_claude(model: str, messages: list[dict]) -> dict:
+# Множители входного тарифа для prompt caching Anthropic
+CACHE_WRITE_MULTIPLIER = 1.25
+CACHE_READ_MULTIPLIER = 0.1
+
+
+def request_claude(model: str, messages: list[dict], params: dict = None) -> dict:
     """
     Синхронная функция, делающая запрос к Anthropic.
+    params: дополнительные параметры генерации (temperature, top_p, max_tokens).
     """
     load_dotenv()
     client = anthropic.Anthropic()
     result = client.messages.create(
         model=model,
-        max_tokens=8192,
-        messages=messages
+        messages=messages,
+        **{"max_tokens": 8192, **(params or {})}
     )
     # Извлекаем сгенерированный ответ
     answer = result.content[0].text
@@ -30,6 +36,9 @@ def request_claude(model: str, messages: list[dict]) -> dict:
     # Извлекаем информацию о токенах из ответа API
     input_tokens = result.usage.input_tokens
     output_tokens = result.usage.output_tokens
+    # Токены префикса, помеченного cache_control, в input_tokens не входят
+    cache_write_tokens = getattr(result.usage, "cache_creation_input_tokens", 0) or 0
+    cache_read_tokens = getattr(result.usage, "cache_read_input_tokens", 0) or 0
 
     # Получаем тарифы для выбранной модели
     model_pricing = pricing.get(model)
@@ -45,6 +54,9 @@ def request_claude(model: str, messages: list[dict]) -> dict:
     # Расчет стоимости:
     # Стоимость некэшированных prompt_tokens
     cost_input = (input_tokens / 1_000_000) * input_rate
+    # Запись в кэш стоит 1.25 входного тарифа, чтение из кэша - 0.1
+    cost_input += (cache_write_tokens / 1_000_000) * input_rate * CACHE_WRITE_MULTIPLIER
+    cost_input += (cache_read_tokens / 1_000_000) * input_rate * CACHE_READ_MULTIPLIER
     # Стоимость output токенов
     cost_output = (output_tokens / 1_000_000) * output_rate
     total_cost = cost_input + cost_output
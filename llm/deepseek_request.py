@@ -3,7 +3,59 @@ import os
 from openai import OpenAI
 from dotenv import load_dotenv
 from datetime import datetime, time, timezone
-from llm_response_cleaner import clean_llm_content
+from .llm_response_cleaner import clean_llm_content
+from .async_clients import get_async_openai, stream_completion
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+load_dotenv()
+
+# Тарифы загружаются один раз при импорте модуля, а не на каждый запрос
+_PRICING_PATH = os.path.join(os.path.dirname(__file__), "llm_pricing.json")
+if orjson is not None:
+    with open(_PRICING_PATH, "rb") as f:
+        _PRICING = orjson.loads(f.read())
+else:
+    with open(_PRICING_PATH, "r", encoding="utf-8") as f:
+        _PRICING = json.load(f)
+
+# Тарифы за один токен по моделям: (input, cached input, output)
+_RATES = {}
+
+
+def _get_rates(model: str) -> tuple:
+    rates = _RATES.get(model)
+    if rates is None:
+        model_pricing = _PRICING.get(model)
+        if not model_pricing:
+            raise Exception(f"Отсутствует информация о стоимости для модели: {model}")
+
+        input_rate = model_pricing.get("1M TOKENS INPUT (CACHE MISS)")
+        cached_rate = model_pricing.get("1M TOKENS INPUT (CACHE HIT)")
+        output_rate = model_pricing.get("1M TOKENS OUTPUT")
+
+        if input_rate is None or cached_rate is None or output_rate is None:
+            raise Exception(f"Не указаны тарифы для входных, кэшированных или выходных "
+                            f"токенов для модели: {model}")
+
+        rates = (input_rate / 1_000_000, cached_rate / 1_000_000, output_rate / 1_000_000)
+        _RATES[model] = rates
+    return rates
+
+
+# Клиент создается один раз и переиспользует пул соединений между запросами
+_client = None
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = OpenAI(api_key=os.getenv("DEEPSEEK_API_KEY"), base_url="https://api.deepseek.com")
+    return _client
 
 
 def is_in_discount_time(discount_time_str: str) -> bool:
@@ -39,64 +91,80 @@ def is_in_discount_time(discount_time_str: str) -> bool:
         return (now_utc >= start_time) or (now_utc < end_time)
 
 
-def request_deepseek(model: str, messages: list) -> dict:
+def request_deepseek(model: str, messages: list, params: dict = None) -> dict:
     """
     Синхронная функция, делающая запрос к OpenAI.
     Возвращает словарь с очищенным контентом и рассчитанной стоимостью.
     """
-    load_dotenv()
-    api_key = os.getenv("DEEPSEEK_API_KEY")
-    client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
+    client = _get_client()
     result = client.chat.completions.create(
         model=model,
         messages=messages,
         stream=False,
-        max_tokens=8000
+        **{"max_tokens": 8000, **(params or {})}
+    )
+    return _build_response(model, result)
+
+
+async def request_deepseek_async(model: str, messages: list, max_output_chars: int = None, params: dict = None) -> dict:
+    """
+    Асинхронный вариант request_deepseek: запрос идет через общий пул соединений httpx без потоков.
+    max_output_chars: если задан, ответ читается потоком и прерывается при превышении
+    этой длины (ResponseTooLongError).
+    """
+    client = get_async_openai(
+        "deepseek",
+        api_key=os.getenv("DEEPSEEK_API_KEY"),
+        base_url="https://api.deepseek.com",
     )
+    if max_output_chars is not None:
+        result = await stream_completion(client, max_output_chars, model=model, messages=messages, **{"max_tokens": 8000, **(params or {})})
+    else:
+        result = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=False,
+            **{"max_tokens": 8000, **(params or {})}
+        )
+    return _build_response(model, result)
+
+
+def _build_response(model: str, result) -> dict:
+    """Очищает ответ модели и рассчитывает стоимость запроса."""
     # Извлекаем сгенерированный ответ
     answer = result.choices[0].message.content
 
     # Очищаем ответ (удаляем возможные обёртки ```json и т. п.)
     answer = clean_llm_content(answer)
 
-    # Загрузка тарифов из файла llm_price.json
-    pricing_path = os.path.join(os.path.dirname(__file__), "llm_pricing.json")
-    with open(pricing_path, "r", encoding="utf-8") as f:
-        pricing = json.load(f)
+    # Без usage (провайдер его не прислал) стоимость посчитать нельзя
+    if result.usage is None:
+        return {"content": answer, "cost": 0.0}
 
     # Извлекаем информацию о токенах из ответа API
     completion_tokens = result.usage.completion_tokens
-    cached_tokens = result.usage.prompt_cache_hit_tokens
-    non_cached_prompt_tokens = result.usage.prompt_cache_miss_tokens
+    cached_tokens = getattr(result.usage, 'prompt_cache_hit_tokens', 0) or 0
+    non_cached_prompt_tokens = getattr(result.usage, 'prompt_cache_miss_tokens', 0) or 0
     
     # Для reasoning моделей (deepseek-reasoner) есть отдельные reasoning tokens
     reasoning_tokens = getattr(result.usage.completion_tokens_details, 'reasoning_tokens', 0) if hasattr(result.usage, 'completion_tokens_details') else 0
     reasoning_tokens = reasoning_tokens or 0  # На случай None
 
-    # Получаем тарифы для выбранной модели
-    model_pricing = pricing.get(model)
-    if not model_pricing:
-        raise Exception(f"Отсутствует информация о стоимости для модели: {model}")
-
-    input_rate = model_pricing.get("1M TOKENS INPUT (CACHE MISS)")
-    cached_rate = model_pricing.get("1M TOKENS INPUT (CACHE HIT)")
-    output_rate = model_pricing.get("1M TOKENS OUTPUT")
-
-    if input_rate is None or cached_rate is None or output_rate is None:
-        raise Exception(f"Не указаны тарифы для входных, кэшированных или выходных "
-                        f"токенов для модели: {model}")
+    # Тарифы за один токен для выбранной модели
+    input_rate, cached_rate, output_rate = _get_rates(model)
 
     # Расчёт стоимости:
     # Стоимость некэшированных prompt_tokens
-    cost_non_cached_prompt = (non_cached_prompt_tokens / 1_000_000) * input_rate
+    cost_non_cached_prompt = non_cached_prompt_tokens * input_rate
     # Стоимость кэшированных prompt_tokens
-    cost_cached = (cached_tokens / 1_000_000) * cached_rate
+    cost_cached = cached_tokens * cached_rate
     # Стоимость output токенов (включая reasoning_tokens для reasoning моделей)
     total_output_tokens = completion_tokens + reasoning_tokens
-    cost_output = (total_output_tokens / 1_000_000) * output_rate
+    cost_output = total_output_tokens * output_rate
     total_cost = cost_non_cached_prompt + cost_cached + cost_output
 
     # Проверяем, есть ли в тарифе поля DISCOUNT TIME и DISCOUNT
+    model_pricing = _PRICING[model]
     discount_time = model_pricing.get("DISCOUNT TIME")
     discount_factor = model_pricing.get("DISCOUNT")
 
@@ -1,31 +1,81 @@
 import json
+import os
 import google.genai as genai
 from dotenv import load_dotenv
-from llm_response_cleaner import clean_llm_content
+from .llm_response_cleaner import clean_llm_content
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def request_gemini(model: str, messages: list) -> dict:
+
+load_dotenv()
+
+# Тарифы загружаются один раз при импорте модуля, а не на каждый запрос
+_PRICING_PATH = os.path.join(os.path.dirname(__file__), "llm_pricing.json")
+if orjson is not None:
+    with open(_PRICING_PATH, "rb") as f:
+        _PRICING = orjson.loads(f.read())
+else:
+    with open(_PRICING_PATH, "r", encoding="utf-8") as f:
+        _PRICING = json.load(f)
+
+# Тарифы за один токен по моделям: (input, cached input, output)
+_RATES = {}
+
+
+def _get_rates(model: str) -> tuple:
+    rates = _RATES.get(model)
+    if rates is None:
+        model_pricing = _PRICING.get(model) or {}
+        rates = (
+            model_pricing.get("1M input tokens", 0) / 1_000_000,
+            model_pricing.get("1M cached** input tokens", 0) / 1_000_000,
+            model_pricing.get("1M output tokens", 0) / 1_000_000,
+        )
+        _RATES[model] = rates
+    return rates
+
+
+# Клиент создается один раз и переиспользует пул соединений между запросами
+_client = None
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = genai.Client()
+    return _client
+
+
+def request_gemini(model: str, messages: list, params: dict = None) -> dict:
     """
     Синхронная функция, делающая запрос к Google Gemini.
     Возвращает словарь с очищенным контентом и рассчитанной стоимостью.
     
     :param model: Название модели (например, 'gemini-2.5-flash', 'gemini-2.5-pro')
     :param messages: Список сообщений в формате [{"role": "user", "content": "..."}]
+    :param params: Параметры генерации в формате OpenAI (temperature, top_p, max_tokens)
     :return: {"content": str, "cost": float}
     """
-    load_dotenv()
-    
-    # Создаем клиент с API ключом из переменной окружения
-    client = genai.Client()
+    # Клиент с API ключом из переменной окружения
+    client = _get_client()
     
     # Преобразуем messages в формат Gemini (просто текст)
     # Gemini API принимает простой текст, объединяем все сообщения
-    contents = "\n".join([msg.get("content", "") for msg in messages])
+    contents = "\n".join(msg["content"] for msg in messages if msg.get("content"))
     
     # Генерируем контент через новый API
+    # max_tokens в Gemini называется max_output_tokens
+    config = dict(params or {})
+    if "max_tokens" in config:
+        config["max_output_tokens"] = config.pop("max_tokens")
+    
     result = client.models.generate_content(
         model=model,
-        contents=contents
+        contents=contents,
+        config=config or None
     )
     
     # Извлекаем сгенерированный ответ
@@ -46,31 +96,17 @@ def request_gemini(model: str, messages: list) -> dict:
     # Рассчитываем количество некэшированных prompt_tokens
     non_cached_prompt_tokens = prompt_tokens - cached_tokens
     
-    # Загрузка тарифов из файла llm_pricing.json
-    pricing_path = os.path.join(os.path.dirname(__file__), "llm_pricing.json")
-    with open(pricing_path, "r", encoding="utf-8") as f:
-        pricing = json.load(f)
+    # Тарифы за один токен для выбранной модели (нули, если тарифов нет)
+    input_rate, cached_rate, output_rate = _get_rates(model)
     
-    # Получаем тарифы для выбранной модели
-    model_pricing = pricing.get(model)
-    if not model_pricing:
-        # Если нет тарифов - возвращаем 0
-        total_cost = 0.0
-    else:
-        input_rate = model_pricing.get("1M input tokens", 0)
-        cached_rate = model_pricing.get("1M cached** input tokens", 0)
-        output_rate = model_pricing.get("1M output tokens", 0)
-        
-        # Расчёт стоимости:
-        # Стоимость некэшированных prompt_tokens
-        cost_non_cached_prompt = (non_cached_prompt_tokens / 1_000_000) * input_rate
-        # Стоимость кэшированных prompt_tokens
-        cost_cached = (cached_tokens / 1_000_000) * cached_rate
-        # Стоимость thoughts токенов (размышления модели - оплачиваются как output)
-        cost_thoughts = (thoughts_tokens / 1_000_000) * output_rate
-        # Стоимость output токенов
-        cost_output = (completion_tokens / 1_000_000) * output_rate
-        total_cost = cost_non_cached_prompt + cost_cached + cost_thoughts + cost_output
+    # Расчёт стоимости:
+    # некэшированные и кэшированные prompt_tokens, а также thoughts токены
+    # (размышления модели - оплачиваются как output) и output токены
+    total_cost = (
+        non_cached_prompt_tokens * input_rate
+        + cached_tokens * cached_rate
+        + (thoughts_tokens + completion_tokens) * output_rate
+    )
     
     return {"content": answer, "cost": total_cost}
 
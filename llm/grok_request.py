@@ -2,10 +2,65 @@ import json
 import os
 from dotenv import load_dotenv
 from openai import OpenAI
-from llm_response_cleaner import clean_llm_content
+from .llm_response_cleaner import clean_llm_content
+from .async_clients import get_async_openai, stream_completion
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def request_grok(model: str, messages: list) -> dict:
+
+load_dotenv()
+
+# Тарифы загружаются один раз при импорте модуля, а не на каждый запрос
+_PRICING_PATH = os.path.join(os.path.dirname(__file__), "llm_pricing.json")
+if orjson is not None:
+    with open(_PRICING_PATH, "rb") as f:
+        _PRICING = orjson.loads(f.read())
+else:
+    with open(_PRICING_PATH, "r", encoding="utf-8") as f:
+        _PRICING = json.load(f)
+
+# Тарифы за один токен по моделям: (input, cached input, output)
+_RATES = {}
+
+
+def _get_rates(model: str) -> tuple:
+    rates = _RATES.get(model)
+    if rates is None:
+        model_pricing = _PRICING.get(model)
+        if not model_pricing:
+            raise Exception(f"Отсутствует информация о стоимости для модели: {model}")
+
+        input_rate = model_pricing.get("1M input tokens")
+        cached_rate = model_pricing.get("1M cached** input tokens")
+        output_rate = model_pricing.get("1M output tokens")
+
+        if input_rate is None or cached_rate is None or output_rate is None:
+            raise Exception(f"Не указаны тарифы для входных, кэшированных или выходных "
+                            f"токенов для модели: {model}")
+
+        rates = (input_rate / 1_000_000, cached_rate / 1_000_000, output_rate / 1_000_000)
+        _RATES[model] = rates
+    return rates
+
+
+# Клиент создается один раз и переиспользует пул соединений между запросами
+_client = None
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = OpenAI(
+            api_key=os.getenv("XAI_API_KEY"),
+            base_url="https://api.x.ai/v1",
+        )
+    return _client
+
+
+def request_grok(model: str, messages: list, params: dict = None) -> dict:
     """
     Синхронная функция, делающая запрос к X.AI Grok.
     Возвращает словарь с очищенным контентом и рассчитанной стоимостью.
@@ -14,20 +69,39 @@ def request_grok(model: str, messages: list) -> dict:
     Для моделей с reasoning общий output = completion_tokens + reasoning_tokens.
     Оба типа токенов стоят одинаково (по тарифу output tokens).
     """
-    load_dotenv()
-    XAI_API_KEY = os.getenv("XAI_API_KEY")
-    
-    # Инициализация клиента X.AI
-    client = OpenAI(
-        api_key=XAI_API_KEY,
-        base_url="https://api.x.ai/v1",
-    )
-    
+    client = _get_client()
     result = client.chat.completions.create(
         model=model,
-        messages=messages
+        messages=messages,
+        **(params or {})
     )
+    return _build_response(model, result)
+
 
+async def request_grok_async(model: str, messages: list, max_output_chars: int = None, params: dict = None) -> dict:
+    """
+    Асинхронный вариант request_grok: запрос идет через общий пул соединений httpx без потоков.
+    max_output_chars: если задан, ответ читается потоком и прерывается при превышении
+    этой длины (ResponseTooLongError).
+    """
+    client = get_async_openai(
+        "xai",
+        api_key=os.getenv("XAI_API_KEY"),
+        base_url="https://api.x.ai/v1",
+    )
+    if max_output_chars is not None:
+        result = await stream_completion(client, max_output_chars, model=model, messages=messages, **(params or {}))
+    else:
+        result = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            **(params or {})
+        )
+    return _build_response(model, result)
+
+
+def _build_response(model: str, result) -> dict:
+    """Очищает ответ модели и рассчитывает стоимость запроса."""
     # Выводим первичный сырой ответ от Grok API в красивом формате
     # print("=== ПЕРВИЧНЫЙ СЫРОЙ ОТВЕТ ОТ GROK API ===")
     # print(json.dumps(result.model_dump(), indent=2, ensure_ascii=False, default=str))
@@ -39,10 +113,9 @@ def request_grok(model: str, messages: list) -> dict:
     # Очищаем ответ (удаляем возможные обёртки ```json и т. п.)
     answer = clean_llm_content(answer)
 
-    # Загрузка тарифов из файла llm_pricing.json
-    pricing_path = os.path.join(os.path.dirname(__file__), "llm_pricing.json")
-    with open(pricing_path, "r", encoding="utf-8") as f:
-        pricing = json.load(f)
+    # Без usage (провайдер его не прислал) стоимость посчитать нельзя
+    if result.usage is None:
+        return {"content": answer, "cost": 0.0}
 
     # Извлекаем информацию о токенах из ответа API
     prompt_tokens = result.usage.prompt_tokens
@@ -55,30 +128,20 @@ def request_grok(model: str, messages: list) -> dict:
     # Рассчитываем количество некэшированных prompt_tokens
     non_cached_prompt_tokens = prompt_tokens - cached_tokens
 
-    # Получаем тарифы для выбранной модели
-    model_pricing = pricing.get(model)
-    if not model_pricing:
-        raise Exception(f"Отсутствует информация о стоимости для модели: {model}")
-
-    input_rate = model_pricing.get("1M input tokens")
-    cached_rate = model_pricing.get("1M cached** input tokens")
-    output_rate = model_pricing.get("1M output tokens")
-
-    if input_rate is None or cached_rate is None or output_rate is None:
-        raise Exception(f"Не указаны тарифы для входных, кэшированных или выходных "
-                        f"токенов для модели: {model}")
+    # Тарифы за один токен для выбранной модели
+    input_rate, cached_rate, output_rate = _get_rates(model)
 
     # Расчёт стоимости:
     # Стоимость некэшированных prompt_tokens
-    cost_non_cached_prompt = (non_cached_prompt_tokens / 1_000_000) * input_rate
+    cost_non_cached_prompt = non_cached_prompt_tokens * input_rate
     # Стоимость кэшированных prompt_tokens
-    cost_cached = (cached_tokens / 1_000_000) * cached_rate
+    cost_cached = cached_tokens * cached_rate
     
     # Стоимость output токенов
     # ВАЖНО: completion_tokens НЕ включает reasoning_tokens, они отдельно!
     # Поэтому нужно считать оба типа токенов
     total_output_tokens = completion_tokens + reasoning_tokens
-    cost_completion = (total_output_tokens / 1_000_000) * output_rate
+    cost_completion = total_output_tokens * output_rate
 
     # Общая стоимость запроса
     total_cost = cost_non_cached_prompt + cost_cached + cost_completion
@@ -1,29 +1,64 @@
-from gpt_request import request_gpt
-from deepseek_request import request_deepseek
-from claude_request import request_claude
-from gemini_request import request_gemini
-from grok_request import request_grok
+import asyncio
+import atexit
+import os
+from concurrent.futures import ThreadPoolExecutor
 
+from .gpt_request import request_gpt, request_gpt_async
+from .deepseek_request import request_deepseek, request_deepseek_async
+from .claude_request import request_claude
+from .gemini_request import request_gemini
+from .grok_request import request_grok, request_grok_async
+from .async_clients import ResponseTooLongError
 
-def llm_request(model: str, messages: list) -> dict:
+
+# Отдельный пул потоков для синхронных провайдеров: пул по умолчанию в asyncio
+# ограничен min(32, cpu + 4) потоками и молча ограничивает параллельность запросов
+_POOL = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("LLM_THREAD_WORKERS", "64")),
+    thread_name_prefix="llm"
+)
+atexit.register(_POOL.shutdown, wait=False)
+
+
+def llm_request(model: str, messages: list, params: dict = None) -> dict:
     """
     Принимает название модели и список сообщений.
     Вызывает соответствующую функцию запроса в зависимости от названия модели.
+    params - дополнительные параметры генерации в формате OpenAI (temperature, top_p,
+    max_tokens); передаются провайдеру как есть.
     """
     if model.startswith("gpt-"):
-        return request_gpt(model, messages)
+        return request_gpt(model, messages, params)
     elif model.startswith("deepseek-"):
-        return request_deepseek(model, messages)
+        return request_deepseek(model, messages, params)
     elif model.startswith("claude-"):
-        return request_claude(model, messages)
+        return request_claude(model, messages, params)
     elif model.startswith("gemini-"):
-        return request_gemini(model, messages)
+        return request_gemini(model, messages, params)
     elif model.startswith("grok-"):
-        return request_grok(model, messages)
+        return request_grok(model, messages, params)
     else:
         raise Exception(f"Модель {model} не поддерживается.")
 
 
+
+async def llm_request_async(model: str, messages: list, max_output_chars: int = None, params: dict = None) -> dict:
+    """
+    Асинхронный вариант llm_request.
+    OpenAI-совместимые провайдеры (GPT, DeepSeek, Grok) вызываются нативно асинхронно,
+    остальные - синхронной функцией в пуле потоков _POOL.
+    max_output_chars (только для OpenAI-совместимых провайдеров): ответ читается потоком
+    и прерывается с ResponseTooLongError, если становится длиннее.
+    """
+    if model.startswith("gpt-"):
+        return await request_gpt_async(model, messages, max_output_chars, params)
+    elif model.startswith("deepseek-"):
+        return await request_deepseek_async(model, messages, max_output_chars, params)
+    elif model.startswith("grok-"):
+        return await request_grok_async(model, messages, max_output_chars, params)
+    return await asyncio.get_running_loop().run_in_executor(_POOL, llm_request, model, messages, params)
+
+
 if __name__ == "__main__":
     import json
 
@@ -0,0 +1,56 @@
+"""
+Дисковый кэш ответов LLM.
+
+Ключ кэша - SHA-256 от пары (модель, промпт), поэтому повторный запуск пайплайна
+на неизмененных отзывах не делает платных запросов. Если diskcache не установлен,
+кэш отключается и запросы выполняются как обычно.
+"""
+
+import hashlib
+import os
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm_cache")
+CACHE_TTL = 7 * 24 * 60 * 60  # 7 дней
+
+_cache = None
+
+
+def _get_cache():
+    """Открывает кэш при первом обращении (или возвращает None без diskcache)."""
+    global _cache
+    if _cache is None and diskcache is not None:
+        _cache = diskcache.Cache(CACHE_DIR)
+    return _cache
+
+
+def cache_key(model: str, prompt: str) -> str:
+    """Возвращает ключ кэша для запроса к модели."""
+    return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+def get_cached(key: str):
+    """
+    Возвращает закэшированный ответ или None.
+
+    Стоимость закэшированного ответа нулевая: повторно за него не платим.
+    """
+    cache = _get_cache()
+    if cache is None:
+        return None
+    result = cache.get(key)
+    if result is None:
+        return None
+    return {"content": result["content"], "cost": 0.0}
+
+
+def set_cached(key: str, result: dict):
+    """Сохраняет ответ модели в кэш."""
+    cache = _get_cache()
+    if cache is not None:
+        cache.set(key, result, expire=CACHE_TTL)
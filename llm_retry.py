@@ -0,0 +1,56 @@
+"""
+Политика повторных попыток для запросов к LLM.
+
+Экспоненциальная задержка со случайным разбросом (jitter) разводит повторы
+параллельных воркеров во времени, а заголовок Retry-After от провайдера,
+если он есть, имеет приоритет.
+"""
+
+from tenacity import AsyncRetrying, retry_if_not_exception_type, stop_after_attempt, wait_exponential_jitter
+
+_backoff = wait_exponential_jitter(initial=1, max=30)
+
+
+def _retry_after(error: BaseException):
+    """Достает задержку в секундах из исключения провайдера (retry_after или заголовок Retry-After)."""
+    value = getattr(error, "retry_after", None)
+    if value is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        if headers is not None:
+            value = headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _wait(retry_state) -> float:
+    retry_after = _retry_after(retry_state.outcome.exception())
+    if retry_after is not None:
+        return retry_after
+    return _backoff(retry_state)
+
+
+def llm_retrying(max_retries: int, logger=None, no_retry: tuple = ()) -> AsyncRetrying:
+    """
+    Создает AsyncRetrying для запросов к LLM.
+
+    Args:
+        max_retries: Максимальное количество попыток
+        logger: Логгер для сообщений о повторах (по умолчанию print)
+        no_retry: Типы исключений, которые пробрасываются сразу, без повторов
+            (ошибки конфигурации, которые повтор не исправит)
+    """
+    log = logger.warning if logger is not None else print
+
+    def before_sleep(retry_state):
+        log(f"  [RETRY] Попытка {retry_state.attempt_number}/{max_retries} не удалась: "
+            f"{retry_state.outcome.exception()}. Повтор через {retry_state.next_action.sleep:.1f}с...")
+
+    return AsyncRetrying(
+        stop=stop_after_attempt(max_retries),
+        retry=retry_if_not_exception_type(no_retry),
+        wait=_wait,
+        before_sleep=before_sleep,
+        reraise=True
+    )
@@ -1,6 +1,8 @@
+import atexit
 import logging
+import queue
 import sys
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import os
 
 
@@ -36,14 +38,22 @@ def setup_logger(name: str, log_file: str = None, level: str = "INFO"):
         # Создаем директорию для логов
         os.makedirs(os.path.dirname(log_file), exist_ok=True)
         
-        # Ротация логов: максимум 10MB, до 5 файлов
+        # Ротация логов: максимум 10MB, до 5 файлов.
+        # Файл открывается при первой записи, а не при создании хендлера
         file_handler = RotatingFileHandler(
             log_file, 
             maxBytes=10*1024*1024,  # 10MB
-            backupCount=5
+            backupCount=5,
+            delay=True
         )
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        
+        # Запись в файл идет в фоновом потоке: вызывающий код только кладет запись в очередь
+        log_queue = queue.Queue(-1)
+        listener = QueueListener(log_queue, file_handler)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(QueueHandler(log_queue))
     
     return logger
 
@@ -64,3 +74,6 @@ def get_update_logger():
 def get_checker_logger():
     return setup_logger('review_checker', 'logs/review_checker.log')
 
+def get_spelling_logger():
+    return setup_logger('spelling_checker', 'logs/spelling_checker.log')
+
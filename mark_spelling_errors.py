@@ -2,10 +2,23 @@ import json
 import os
 import asyncio
 from datetime import datetime
-from spelling_checker import check_spelling
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-async def check_spelling_with_retry(text: str, model: str, max_retries: int = 3) -> dict:
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from spelling_checker import check_spelling, UnknownModelError
+from llm_retry import llm_retrying
+from rate_limiter import LLMLimiter
+
+
+async def check_spelling_with_retry(text: str, model: str, max_retries: int = 3, limiter: LLMLimiter = None) -> dict:
     """
     Вызывает check_spelling с повторными попытками при ошибке.
     
@@ -13,6 +26,9 @@ async def check_spelling_with_retry(text: str, model: str, max_retries: int = 3)
         text: Текст для проверки орфографии
         model: Модель для обработки
         max_retries: Максимальное количество попыток (по умолчанию 3)
+        limiter: Ограничитель запросов (LLMLimiter). Передается в check_spelling и
+            захватывается на каждый запрос к модели (длинный текст дает несколько запросов),
+            поэтому каждый повтор учитывается в rpm, а паузы между попытками не занимают слот
         
     Returns:
         Результат от check_spelling
@@ -20,25 +36,20 @@ async def check_spelling_with_retry(text: str, model: str, max_retries: int = 3)
     Raises:
         Exception: Если все попытки завершились ошибкой
     """
-    last_error = None
-    
-    for attempt in range(1, max_retries + 1):
-        try:
-            result = await check_spelling(text=text, model=model)
-            return result
-        except Exception as e:
-            last_error = e
-            if attempt < max_retries:
-                wait_time = attempt * 2
-                print(f"  [RETRY] Попытка {attempt}/{max_retries} не удалась: {e}. Повтор через {wait_time}с...")
-                await asyncio.sleep(wait_time)
-            else:
-                print(f"  [ERROR] Все {max_retries} попытки исчерпаны: {e}")
-    
-    raise last_error
+    try:
+        # Неизвестная модель - ошибка конфигурации, повторять запрос бессмысленно
+        async for attempt in llm_retrying(max_retries, no_retry=(UnknownModelError,)):
+            with attempt:
+                return await check_spelling(text=text, model=model, limiter=limiter)
+    except UnknownModelError as e:
+        print(f"  [ERROR] {e}")
+        raise
+    except Exception as e:
+        print(f"  [ERROR] Все {max_retries} попытки исчерпаны: {e}")
+        raise
 
 
-async def mark_single_review(review: dict, sheet_name: str, worksheet_name: str, model: str, max_retries: int = 3) -> dict:
+async def mark_single_review(review: dict, sheet_name: str, worksheet_name: str, model: str, max_retries: int = 3, stamp: str = None, limiter: LLMLimiter = None) -> dict:
     """
     Размечает орфографические ошибки в одном отзыве.
     
@@ -48,6 +59,8 @@ async def mark_single_review(review: dict, sheet_name: str, worksheet_name: str,
         worksheet_name: Название листа
         model: Модель для разметки
         max_retries: Максимальное количество попыток при ошибке
+        stamp: Время разметки для marked_at (по умолчанию текущее)
+        limiter: Ограничитель запросов (LLMLimiter), захватываемый на каждую попытку
         
     Returns:
         Обновленный словарь с размеченным corrected_text
@@ -60,14 +73,14 @@ async def mark_single_review(review: dict, sheet_name: str, worksheet_name: str,
             return review
         
         # Размечаем орфографические ошибки
-        result = await check_spelling_with_retry(text=corrected_text, model=model, max_retries=max_retries)
+        result = await check_spelling_with_retry(text=corrected_text, model=model, max_retries=max_retries, limiter=limiter)
         marked_text = result.get("content", corrected_text)
         cost = result.get("cost", 0)
         
         # Обновляем данные отзыва
         review["corrected_text"] = marked_text
         review["spelling_cost"] = cost
-        review["marked_at"] = datetime.now().isoformat()
+        review["marked_at"] = stamp or datetime.now().isoformat()
         
         print(f"  [OK] Размечены ошибки в отзыве в {sheet_name}/{worksheet_name} (cost: ${cost:.6f})")
         
@@ -78,7 +91,7 @@ async def mark_single_review(review: dict, sheet_name: str, worksheet_name: str,
         return review
 
 
-async def mark_all_reviews(data: dict, model: str = "grok-4-1-fast-reasoning", max_concurrent: int = 50, max_retries: int = 3) -> dict:
+async def mark_all_reviews(data: dict, model: str = "grok-4-1-fast-reasoning", max_concurrent: int = 50, max_retries: int = 3, limiter: LLMLimiter = None) -> dict:
     """
     Асинхронно размечает орфографические ошибки во всех отзывах.
     
@@ -87,6 +100,8 @@ async def mark_all_reviews(data: dict, model: str = "grok-4-1-fast-reasoning", m
         model: Модель для разметки
         max_concurrent: Максимальное количество параллельных запросов
         max_retries: Максимальное количество попыток при ошибке
+        limiter: Общий ограничитель запросов пайплайна (LLMLimiter). Если передан,
+            max_concurrent не используется
         
     Returns:
         Обновленная структура данных с размеченными отзывами
@@ -98,15 +113,34 @@ async def mark_all_reviews(data: dict, model: str = "grok-4-1-fast-reasoning", m
     print(f"Максимум попыток при ошибке: {max_retries}")
     print(f"{'='*60}\n")
     
-    # Семафор для ограничения количества параллельных запросов
-    semaphore = asyncio.Semaphore(max_concurrent)
+    # Ограничитель количества параллельных запросов (общий для пайплайна, если передан)
+    if limiter is None:
+        limiter = LLMLimiter(max_concurrent)
     
-    async def mark_with_semaphore(review, sheet_name, worksheet_name):
-        async with semaphore:
-            return await mark_single_review(review, sheet_name, worksheet_name, model, max_retries)
+    # Одна отметка времени на весь запуск вместо datetime.now() на каждый отзыв
+    stamp = datetime.now().isoformat()
     
-    # Собираем все задачи для асинхронной обработки
-    tasks = []
+    # Стоимость накапливается по мере обработки, без отдельного прохода по данным
+    total_cost = 0.0
+    
+    async def mark_group(entries):
+        """Размечает один уникальный текст и сразу записывает результат во все его копии."""
+        nonlocal total_cost
+        sheet_name, worksheet_name, index, review = entries[0]
+        result = await mark_single_review(review, sheet_name, worksheet_name, model, max_retries, stamp, limiter)
+        data[sheet_name][worksheet_name][index] = result
+        total_cost += result.get("spelling_cost", 0)
+        
+        # Дубликаты получают тот же результат без повторной оплаты
+        for sheet_name, worksheet_name, index, review in entries[1:]:
+            if "marked_at" in result:
+                review["corrected_text"] = result["corrected_text"]
+                review["spelling_cost"] = 0.0
+                review["marked_at"] = result["marked_at"]
+            data[sheet_name][worksheet_name][index] = review
+    
+    # Группируем одинаковые тексты: один запрос к LLM на каждый уникальный corrected_text
+    groups = {}
     total_reviews = 0
     
     for sheet_name, worksheets in data.items():
@@ -115,31 +149,22 @@ async def mark_all_reviews(data: dict, model: str = "grok-4-1-fast-reasoning", m
             print(f"Количество отзывов: {len(reviews)}")
             
             for i, review in enumerate(reviews):
-                task = mark_with_semaphore(review, sheet_name, worksheet_name)
-                tasks.append((sheet_name, worksheet_name, i, task))
+                key = review.get("corrected_text", "")
+                groups.setdefault(key, []).append((sheet_name, worksheet_name, i, review))
                 total_reviews += 1
     
     print(f"\n{'='*60}")
     print(f"Всего отзывов к обработке: {total_reviews}")
+    print(f"Уникальных текстов (запросов к LLM): {len(groups)}")
     print(f"{'='*60}\n")
     
-    # Выполняем все задачи параллельно
+    # Выполняем все задачи параллельно; каждая записывает результат сама
     start_time = datetime.now()
-    results = await asyncio.gather(*[task for _, _, _, task in tasks])
+    await asyncio.gather(*[mark_group(entries) for entries in groups.values()])
     end_time = datetime.now()
     
-    # Обновляем данные результатами
-    for (sheet_name, worksheet_name, index, _), result in zip(tasks, results):
-        data[sheet_name][worksheet_name][index] = result
-    
     # Статистика
     duration = (end_time - start_time).total_seconds()
-    total_cost = sum(
-        review.get("spelling_cost", 0)
-        for worksheets in data.values()
-        for reviews in worksheets.values()
-        for review in reviews
-    )
     
     print(f"\n{'='*60}")
     print(f"[OK] Разметка завершена!")
@@ -153,29 +178,66 @@ async def mark_all_reviews(data: dict, model: str = "grok-4-1-fast-reasoning", m
 
 
 def load_reviews(input_file: str) -> dict:
-    """Загружает данные отзывов из JSON файла."""
+    """
+    Загружает данные отзывов из файла.
+    
+    Файлы .msgpack читаются через msgpack (компактнее и быстрее JSON при передаче
+    данных между этапами), остальные - как JSON (через orjson, если он установлен).
+    """
+    if input_file.endswith(".msgpack"):
+        if msgpack is None:
+            raise ImportError("Для чтения .msgpack файлов нужен пакет msgpack")
+        with open(input_file, "rb") as f:
+            return msgpack.unpackb(f.read())
+    if orjson is not None:
+        with open(input_file, "rb") as f:
+            return orjson.loads(f.read())
     with open(input_file, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
 def save_reviews(data: dict, output_file: str):
-    """Сохраняет обработанные данные в JSON файл."""
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    """Сохраняет обработанные данные в .msgpack или JSON файл (по расширению)."""
+    if output_file.endswith(".msgpack"):
+        if msgpack is None:
+            raise ImportError("Для записи .msgpack файлов нужен пакет msgpack")
+        with open(output_file, "wb") as f:
+            f.write(msgpack.packb(data))
+    elif orjson is not None:
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
     print(f"Результаты сохранены в: {output_file}")
 
 
+def main(input_file: str, output_file: str, model: str = "grok-4-1-fast-reasoning", max_concurrent: int = 100, max_retries: int = 3, data: dict = None) -> dict:
+    """
+    Размечает орфографические ошибки и сохраняет результат в output_file.
+    
+    Если data передан (например, результат process_reviews.main), input_file не читается:
+    данные между этапами передаются в памяти.
+    
+    Returns:
+        Размеченные данные
+    """
+    if data is None:
+        data = load_reviews(input_file)
+    marked_data = asyncio.run(mark_all_reviews(data, model=model, max_concurrent=max_concurrent, max_retries=max_retries))
+    save_reviews(marked_data, output_file)
+    return marked_data
+
+
 if __name__ == "__main__":
     # Настройки
     MODEL = "grok-4-1-fast-reasoning"
     MAX_CONCURRENT = 100
     MAX_RETRIES = 3
     
+    # Файл .msgpack вместо .json уменьшает объем промежуточных данных
     current_dir = os.path.dirname(os.path.abspath(__file__))
     input_file = os.path.join(current_dir, "gsheets", "test_data", "processed_reviews.json")
     output_file = os.path.join(current_dir, "gsheets", "test_data", "marked_reviews.json")
     
-    reviews_data = load_reviews(input_file)
-    marked_data = asyncio.run(mark_all_reviews(reviews_data, model=MODEL, max_concurrent=MAX_CONCURRENT, max_retries=MAX_RETRIES))
-    save_reviews(marked_data, output_file)
-
+    main(input_file, output_file, model=MODEL, max_concurrent=MAX_CONCURRENT, max_retries=MAX_RETRIES)
@@ -0,0 +1,70 @@
+"""
+Поиск почти одинаковых отзывов (MinHash + LSH).
+
+Для шаблонных отзывов, отличающихся парой символов, достаточно одного запроса к LLM
+на кластер. Кандидаты из LSH дополнительно проверяются точным коэффициентом Жаккара,
+поэтому ложные срабатывания LSH не объединяются.
+"""
+
+try:
+    from datasketch import MinHash, MinHashLSH
+except ImportError:
+    MinHash = MinHashLSH = None
+
+
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+
+
+def _shingles(text: str) -> set:
+    """Символьные 5-граммы нормализованного текста."""
+    normalized = " ".join(text.lower().split())
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized}
+    return {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def find_representatives(texts: list, threshold: float = 0.9) -> list:
+    """
+    Находит для каждого текста представителя его кластера почти одинаковых текстов.
+
+    Args:
+        texts: Список текстов
+        threshold: Минимальный коэффициент Жаккара по 5-граммам для объединения
+
+    Returns:
+        Список той же длины: индекс представителя для каждого текста
+        (сам текст, если похожих до него не было)
+
+    Raises:
+        ImportError: Если не установлен datasketch
+    """
+    if MinHashLSH is None:
+        raise ImportError("Для поиска почти одинаковых отзывов нужен пакет datasketch")
+
+    lsh = MinHashLSH(threshold=threshold, num_perm=NUM_PERM)
+    shingles = [_shingles(text) for text in texts]
+    representatives = list(range(len(texts)))
+
+    for i, text in enumerate(texts):
+        if not text:
+            continue
+        minhash = MinHash(num_perm=NUM_PERM)
+        for shingle in shingles[i]:
+            minhash.update(shingle.encode("utf-8"))
+
+        # Представителем становится самый ранний кандидат, прошедший точную проверку
+        candidates = sorted(int(key) for key in lsh.query(minhash))
+        for candidate in candidates:
+            if _jaccard(shingles[i], shingles[candidate]) >= threshold:
+                representatives[i] = candidate
+                break
+        else:
+            # В индекс попадают только представители: кластеры не разрастаются цепочкой
+            lsh.insert(str(i), minhash)
+
+    return representatives
@@ -1,14 +1,35 @@
 import json
 import os
 import asyncio
+import hashlib
+from contextlib import nullcontext
 from datetime import datetime
-from review_checker import check_review
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from review_checker import check_review, check_reviews_batch, BatchResponseError, UnknownModelError
 from logger_config import get_process_logger
+from llm_retry import llm_retrying
+from rate_limiter import LLMLimiter
+from near_dedup import find_representatives
 
 logger = get_process_logger()
 
 
-async def check_review_with_retry(review_text: str, gender: str, model: str, max_retries: int = 3) -> dict:
+async def check_review_with_retry(review_text: str, gender: str, model: str, max_retries: int = 3, limiter: LLMLimiter = None) -> dict:
     """
     Вызывает check_review с повторными попытками при ошибке.
     
@@ -17,6 +38,8 @@ async def check_review_with_retry(review_text: str, gender: str, model: str, max
         gender: Пол
         model: Модель для обработки
         max_retries: Максимальное количество попыток (по умолчанию 3)
+        limiter: Ограничитель запросов (LLMLimiter). Захватывается на каждую попытку,
+            поэтому каждый повтор учитывается в rpm, а паузы между попытками не занимают слот
         
     Returns:
         Результат от check_review
@@ -24,25 +47,78 @@ async def check_review_with_retry(review_text: str, gender: str, model: str, max
     Raises:
         Exception: Если все попытки завершились ошибкой
     """
-    last_error = None
+    try:
+        # Неизвестная модель - ошибка конфигурации, повторять запрос бессмысленно
+        async for attempt in llm_retrying(max_retries, logger, no_retry=(UnknownModelError,)):
+            with attempt:
+                async with limiter or nullcontext():
+                    return await check_review(review_text=review_text, gender=gender, model=model)
+    except UnknownModelError as e:
+        logger.error(f"  [ERROR] {e}")
+        raise
+    except Exception as e:
+        logger.error(f"  [ERROR] Все {max_retries} попытки исчерпаны: {e}")
+        raise
+
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """Создает цикл событий uvloop, если он установлен, иначе стандартный."""
+    if uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+def text_hash(text: str) -> str:
+    """Хэш текста отзыва, по которому определяется, что отзыв уже обработан."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def apply_check_result(review: dict, result: dict, sheet_name: str, worksheet_name: str, stamp: str = None) -> dict:
+    """
+    Записывает ответ модели в отзыв.
     
-    for attempt in range(1, max_retries + 1):
-        try:
-            result = await check_review(review_text=review_text, gender=gender, model=model)
-            return result
-        except Exception as e:
-            last_error = e
-            if attempt < max_retries:
-                wait_time = attempt * 2  # Увеличиваем задержку с каждой попыткой
-                logger.warning(f"  [RETRY] Попытка {attempt}/{max_retries} не удалась: {e}. Повтор через {wait_time}с...")
-                await asyncio.sleep(wait_time)
-            else:
-                logger.error(f"  [ERROR] Все {max_retries} попытки исчерпаны: {e}")
+    Args:
+        review: Словарь с полями text, gender, corrected_text
+        result: Ответ модели {"content": str, "cost": float}
+        sheet_name: Название таблицы
+        worksheet_name: Название листа
+        stamp: Время обработки для processed_at (по умолчанию текущее)
+        
+    Returns:
+        Обновленный словарь с заполненными corrected_text и gender. Если ответ
+        не удалось разобрать, записывается только стоимость: отзыв остается
+        необработанным (без processed_at) и будет обработан повторно
+    """
+    text = review.get("text", "")
+    gender = review.get("gender", "")
+    
+    # Парсим ответ от модели
+    content = result.get("content", "{}")
+    cost = result.get("cost", 0)
+    
+    try:
+        # Пытаемся распарсить JSON из ответа
+        corrected_data = orjson.loads(content) if orjson is not None else json.loads(content)
+        corrected_text = corrected_data.get("text", text)
+        corrected_gender = corrected_data.get("gender", gender)
+    except json.JSONDecodeError:
+        logger.warning(f"Ошибка парсинга JSON для отзыва в {sheet_name}/{worksheet_name}")
+        review["cost"] = cost
+        return review
+    
+    # Обновляем данные отзыва
+    review["corrected_text"] = corrected_text
+    review["gender"] = corrected_gender
+    review["cost"] = cost
+    review["processed_at"] = stamp or datetime.now().isoformat()
+    review["text_hash"] = text_hash(text)
+    
+    logger.info(f"Обработан отзыв в {sheet_name}/{worksheet_name} (cost: ${cost:.6f})")
     
-    raise last_error
+    return review
 
 
-async def process_single_review(review: dict, sheet_name: str, worksheet_name: str, model: str = "grok-4-1-fast-reasoning", max_retries: int = 3) -> dict:
+async def process_single_review(review: dict, sheet_name: str, worksheet_name: str, model: str = "grok-4-1-fast-reasoning", max_retries: int = 3, stamp: str = None, limiter: LLMLimiter = None) -> dict:
     """
     Обрабатывает один отзыв через LLM.
     
@@ -52,6 +128,8 @@ async def process_single_review(review: dict, sheet_name: str, worksheet_name: s
         worksheet_name: Название листа
         model: Модель для обработки
         max_retries: Максимальное количество попыток при ошибке (по умолчанию 3)
+        stamp: Время обработки для processed_at (по умолчанию текущее)
+        limiter: Ограничитель запросов (LLMLimiter), захватываемый на каждую попытку
         
     Returns:
         Обновленный словарь с заполненными corrected_text и gender
@@ -65,46 +143,61 @@ async def process_single_review(review: dict, sheet_name: str, worksheet_name: s
             return review
         
         # Вызываем функцию проверки отзыва с повторными попытками
-        result = await check_review_with_retry(review_text=text, gender=gender, model=model, max_retries=max_retries)
-        
-        # Парсим ответ от модели
-        content = result.get("content", "{}")
-        cost = result.get("cost", 0)
-        
-        try:
-            # Пытаемся распарсить JSON из ответа
-            corrected_data = json.loads(content)
-            corrected_text = corrected_data.get("text", text)
-            corrected_gender = corrected_data.get("gender", gender)
-        except json.JSONDecodeError:
-            logger.warning(f"Ошибка парсинга JSON для отзыва в {sheet_name}/{worksheet_name}")
-            corrected_text = text
-            corrected_gender = gender
-        
-        # Обновляем данные отзыва
-        review["corrected_text"] = corrected_text
-        review["gender"] = corrected_gender
-        review["cost"] = cost
-        review["processed_at"] = datetime.now().isoformat()
+        result = await check_review_with_retry(review_text=text, gender=gender, model=model, max_retries=max_retries, limiter=limiter)
         
-        logger.info(f"Обработан отзыв в {sheet_name}/{worksheet_name} (cost: ${cost:.6f})")
-        
-        return review
+        return apply_check_result(review, result, sheet_name, worksheet_name, stamp)
         
     except Exception as e:
         logger.error(f"Ошибка обработки отзыва в {sheet_name}/{worksheet_name}: {e}", exc_info=True)
         return review
 
 
-async def process_all_reviews(data: dict, model: str, max_concurrent: int, max_retries: int) -> dict:
+def load_checkpoint(checkpoint_path: str) -> dict:
+    """
+    Загружает уже обработанные отзывы из файла контрольной точки (JSONL).
+    
+    Returns:
+        Словарь id -> запись {"id": ..., "text": ..., "review": {...}}
+    """
+    done = {}
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return done
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Последняя строка могла оборваться при аварийном завершении
+                continue
+            done[record["id"]] = record
+    return done
+
+
+async def process_all_reviews(data: dict, model: str, max_concurrent: int, max_retries: int, rpm: int = None, checkpoint_path: str = None, near_dup_threshold: float = None, batch_size: int = 1, limiter: LLMLimiter = None) -> dict:
     """
     Асинхронно обрабатывает все отзывы из структуры данных.
     
+    Отзывы раздаются через очередь фиксированному пулу из max_concurrent воркеров,
+    поэтому задачи не создаются заранее на каждый отзыв.
+    
     Args:
         data: Структура данных из reviews_data.json
         model: Модель для обработки
         max_concurrent: Максимальное количество параллельных запросов
         max_retries: Максимальное количество попыток при ошибке (по умолчанию 3)
+        rpm: Ограничение запросов к LLM в минуту (None - без ограничения)
+        checkpoint_path: Файл контрольной точки (JSONL). Каждый обработанный отзыв
+            дописывается в него сразу, а при перезапуске уже обработанные отзывы пропускаются
+        near_dup_threshold: Порог Жаккара для объединения почти одинаковых отзывов (None - выключено).
+            Если представитель кластера не потребовал исправлений, остальные отзывы кластера
+            считаются проверенными (свой текст без изменений, поле deduped_from). Если
+            представитель исправлен, его правки к чужому тексту не переносятся: такие отзывы
+            отправляются в LLM отдельно после основного прохода
+        batch_size: Количество отзывов в одном запросе к LLM (1 - по одному отзыву).
+            Общие инструкции промпта оплачиваются один раз на пакет; если ответ на пакет
+            не удалось разобрать, отзывы пакета обрабатываются по одному
+        limiter: Общий ограничитель запросов пайплайна (LLMLimiter). Если передан,
+            параллельность и rpm задаются им, а параметр rpm не используется
         
     Returns:
         Обновленная структура данных с обработанными отзывами
@@ -114,17 +207,27 @@ async def process_all_reviews(data: dict, model: str, max_concurrent: int, max_r
     logger.info(f"Модель: {model}")
     logger.info(f"Максимум параллельных запросов: {max_concurrent}")
     logger.info(f"Максимум попыток при ошибке: {max_retries}")
+    if limiter is None:
+        limiter = LLMLimiter(max_concurrent, rpm)
+    else:
+        logger.info(f"Используется общий ограничитель пайплайна: {limiter.max_concurrent} параллельных запросов")
+    if limiter.rpm:
+        logger.info(f"Ограничение запросов в минуту: {limiter.rpm}")
     logger.info("="*60)
     
-    # Семафор для ограничения количества параллельных запросов
-    semaphore = asyncio.Semaphore(max_concurrent)
+    # Одна отметка времени на весь запуск вместо datetime.now() на каждый отзыв
+    stamp = datetime.now().isoformat()
+    
+    # Восстанавливаем результаты прошлого прерванного запуска
+    done = load_checkpoint(checkpoint_path)
+    restored = 0
+    skipped = 0
     
-    async def process_with_semaphore(review, sheet_name, worksheet_name):
-        async with semaphore:
-            return await process_single_review(review, sheet_name, worksheet_name, model, max_retries)
+    # Стоимость накапливается по мере обработки, без отдельного прохода по данным
+    total_cost = 0.0
     
-    # Собираем все задачи для асинхронной обработки
-    tasks = []
+    # Группируем одинаковые отзывы: один запрос к LLM на каждую пару (текст, пол)
+    groups = {}
     total_reviews = 0
     
     for sheet_name, worksheets in data.items():
@@ -133,31 +236,172 @@ async def process_all_reviews(data: dict, model: str, max_concurrent: int, max_r
             logger.info(f"Количество отзывов: {len(reviews)}")
             
             for i, review in enumerate(reviews):
-                task = process_with_semaphore(review, sheet_name, worksheet_name)
-                tasks.append((sheet_name, worksheet_name, i, task))
+                record = done.get(f"{sheet_name}/{worksheet_name}/{i}")
+                if record is not None and record["text"] == review.get("text", ""):
+                    reviews[i] = record["review"]
+                    total_cost += reviews[i].get("cost", 0)
+                    restored += 1
+                    total_reviews += 1
+                    continue
+                
+                # Отзыв уже обработан в прошлом запуске, и его текст с тех пор не менялся
+                if "processed_at" in review and review.get("text_hash") == text_hash(review.get("text", "")):
+                    skipped += 1
+                    total_reviews += 1
+                    continue
+                
+                key = (review.get("text", ""), review.get("gender", ""))
+                groups.setdefault(key, []).append((sheet_name, worksheet_name, i, review))
                 total_reviews += 1
     
     logger.info("="*60)
     logger.info(f"Всего отзывов к обработке: {total_reviews}")
+    if restored:
+        logger.info(f"Восстановлено из контрольной точки: {restored}")
+    if skipped:
+        logger.info(f"Пропущено уже обработанных отзывов: {skipped}")
+    
+    # Объединяем почти одинаковые отзывы в группу их представителя
+    deduped_from = {}
+    if near_dup_threshold is not None and groups:
+        # Промпт меняет формы слов по полу, поэтому объединяются только отзывы одного пола
+        by_gender = {}
+        for key in groups:
+            by_gender.setdefault(key[1], []).append(key)
+        for keys in by_gender.values():
+            representatives = find_representatives([text for text, _ in keys], near_dup_threshold)
+            for key, rep in zip(keys, representatives):
+                rep_key = keys[rep]
+                if rep_key == key:
+                    continue
+                rep_sheet, rep_worksheet, rep_index, _ = groups[rep_key][0]
+                for entry in groups.pop(key):
+                    deduped_from[id(entry[3])] = f"{rep_sheet}/{rep_worksheet}/{rep_index}"
+                    groups[rep_key].append(entry)
+        if deduped_from:
+            logger.info(f"Объединено почти одинаковых отзывов: {len(deduped_from)}")
+    
+    logger.info(f"Уникальных отзывов (запросов к LLM): {len(groups)}")
     logger.info("="*60)
     
-    # Выполняем все задачи параллельно
-    start_time = datetime.now()
-    results = await asyncio.gather(*[task for _, _, _, task in tasks])
-    end_time = datetime.now()
+    checkpoint = open(checkpoint_path, "a", encoding="utf-8", buffering=1) if checkpoint_path else None
+    
+    def save_checkpoint(sheet_name, worksheet_name, index, review):
+        if checkpoint is not None and "processed_at" in review:
+            checkpoint.write(json.dumps({
+                "id": f"{sheet_name}/{worksheet_name}/{index}",
+                "text": review.get("text", ""),
+                "review": review
+            }, ensure_ascii=False) + "\n")
+    
+    queue = asyncio.Queue()
+    for entries in groups.values():
+        queue.put_nowait(entries)
     
-    # Обновляем данные результатами
-    for (sheet_name, worksheet_name, index, _), result in zip(tasks, results):
+    # Почти одинаковые отзывы, представитель которых был исправлен: (текст, пол) -> записи
+    requeue = {}
+    
+    def finish(entries, result):
+        """Записывает результат группы в данные и контрольную точку."""
+        nonlocal total_cost
+        sheet_name, worksheet_name, index, _ = entries[0]
         data[sheet_name][worksheet_name][index] = result
+        total_cost += result.get("cost", 0)
+        save_checkpoint(sheet_name, worksheet_name, index, result)
+        
+        # Дубликаты получают тот же результат без повторной оплаты
+        for sheet_name, worksheet_name, index, review in entries[1:]:
+            if "processed_at" in result:
+                if id(review) not in deduped_from:
+                    review["corrected_text"] = result["corrected_text"]
+                elif result["corrected_text"] == result.get("text", ""):
+                    # Представитель без ошибок: почти одинаковый отзыв сохраняет свой текст
+                    review["corrected_text"] = review.get("text", "")
+                    review["deduped_from"] = deduped_from[id(review)]
+                else:
+                    # Правки представителя к другому тексту не переносятся
+                    del deduped_from[id(review)]
+                    key = (review.get("text", ""), review.get("gender", ""))
+                    requeue.setdefault(key, []).append((sheet_name, worksheet_name, index, review))
+                    continue
+                review["gender"] = result["gender"]
+                review["cost"] = 0.0
+                review["processed_at"] = result["processed_at"]
+                review["text_hash"] = text_hash(review.get("text", ""))
+            data[sheet_name][worksheet_name][index] = review
+            save_checkpoint(sheet_name, worksheet_name, index, review)
+    
+    async def process_group(entries):
+        sheet_name, worksheet_name, _, review = entries[0]
+        result = await process_single_review(review, sheet_name, worksheet_name, model, max_retries, stamp, limiter)
+        finish(entries, result)
+    
+    async def process_batch(batch):
+        """Обрабатывает несколько групп одним запросом; при ошибке - по одной."""
+        nonlocal total_cost
+        items = [(entries[0][3].get("text", ""), entries[0][3].get("gender", "")) for entries in batch]
+        try:
+            # Ограничитель захватывается на каждую попытку, а не на весь цикл повторов
+            async for attempt in llm_retrying(max_retries, logger, no_retry=(UnknownModelError,)):
+                with attempt:
+                    async with limiter:
+                        try:
+                            batch_result = await check_reviews_batch(items, model)
+                        except BatchResponseError as e:
+                            # Неразобранный ответ уже оплачен
+                            total_cost += e.cost
+                            raise
+        except Exception as e:
+            logger.warning(f"Пакетный запрос на {len(batch)} отзывов не удался ({e}), обрабатываем по одному")
+            # Отзывы пакета отправляются параллельно; общий лимит соблюдает limiter
+            await asyncio.gather(*[process_group(entries) for entries in batch])
+            return
+        
+        # Стоимость запроса делится поровну между отзывами пакета
+        cost = batch_result["cost"] / len(batch)
+        for entries, content in zip(batch, batch_result["content"]):
+            sheet_name, worksheet_name, _, review = entries[0]
+            result = apply_check_result(review, {"content": content, "cost": cost}, sheet_name, worksheet_name, stamp)
+            finish(entries, result)
+    
+    async def worker():
+        while True:
+            batch = []
+            while len(batch) < batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            if not batch:
+                return
+            
+            # Пустые отзывы в пакет не попадают
+            for entries in batch:
+                if not entries[0][3].get("text", ""):
+                    await process_group(entries)
+            batch = [entries for entries in batch if entries[0][3].get("text", "")]
+            
+            if len(batch) > 1:
+                await process_batch(batch)
+            elif batch:
+                await process_group(batch[0])
+    
+    # Запускаем пул воркеров
+    start_time = datetime.now()
+    try:
+        workers = min(max_concurrent, -(-len(groups) // batch_size))
+        await asyncio.gather(*[worker() for _ in range(workers)])
+        if requeue:
+            logger.info(f"Почти одинаковых отзывов с исправленным представителем: {sum(map(len, requeue.values()))}, "
+                        f"отправляем в LLM отдельно")
+            await asyncio.gather(*[process_group(entries) for entries in requeue.values()])
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+    end_time = datetime.now()
     
     # Статистика
     duration = (end_time - start_time).total_seconds()
-    total_cost = sum(
-        review.get("cost", 0)
-        for worksheets in data.values()
-        for reviews in worksheets.values()
-        for review in reviews
-    )
     
     logger.info("="*60)
     logger.info("[OK] Обработка завершена!")
@@ -172,29 +416,72 @@ async def process_all_reviews(data: dict, model: str, max_concurrent: int, max_r
 
 
 def load_reviews(input_file: str) -> dict:
-    """Загружает данные отзывов из JSON файла."""
+    """
+    Загружает данные отзывов из файла.
+    
+    Файлы .msgpack читаются через msgpack (компактнее и быстрее JSON при передаче
+    данных между этапами), остальные - как JSON (через orjson, если он установлен).
+    """
+    if input_file.endswith(".msgpack"):
+        if msgpack is None:
+            raise ImportError("Для чтения .msgpack файлов нужен пакет msgpack")
+        with open(input_file, "rb") as f:
+            return msgpack.unpackb(f.read())
+    if orjson is not None:
+        with open(input_file, "rb") as f:
+            return orjson.loads(f.read())
     with open(input_file, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
 def save_reviews(data: dict, output_file: str):
-    """Сохраняет обработанные данные в JSON файл."""
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    """Сохраняет обработанные данные в .msgpack или JSON файл (по расширению)."""
+    if output_file.endswith(".msgpack"):
+        if msgpack is None:
+            raise ImportError("Для записи .msgpack файлов нужен пакет msgpack")
+        with open(output_file, "wb") as f:
+            f.write(msgpack.packb(data))
+    elif orjson is not None:
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
     logger.info(f"Результаты сохранены в: {output_file}")
 
 
+def main(input_file: str, output_file: str, model: str = "gpt-4o", max_concurrent: int = 100, max_retries: int = 3) -> dict:
+    """
+    Обрабатывает отзывы из input_file и сохраняет результат в output_file.
+    
+    Формат файлов определяется расширением (.msgpack или JSON). Во время обработки
+    рядом с output_file ведется контрольная точка, которая удаляется после сохранения.
+    
+    Returns:
+        Обработанные данные (для передачи следующему этапу без повторного чтения файла)
+    """
+    checkpoint_file = output_file + ".checkpoint.jsonl"
+    
+    reviews_data = load_reviews(input_file)
+    with asyncio.Runner(loop_factory=new_event_loop) as runner:
+        processed_data = runner.run(process_all_reviews(reviews_data, model=model, max_concurrent=max_concurrent, max_retries=max_retries, checkpoint_path=checkpoint_file))
+    save_reviews(processed_data, output_file)
+    
+    # Результаты сохранены целиком - контрольная точка больше не нужна
+    os.remove(checkpoint_file)
+    
+    return processed_data
+
+
 if __name__ == "__main__":
     # Настройки
     MODEL = "gpt-4o"
     MAX_CONCURRENT = 100
     MAX_RETRIES = 3  # Количество попыток при ошибке
     
+    # Для передачи данных следующему этапу можно указать файл .msgpack вместо .json
     current_dir = os.path.dirname(os.path.abspath(__file__))
     input_file = os.path.join(current_dir, "gsheets", "test_data", "reviews_data.json")
     output_file = os.path.join(current_dir, "gsheets", "test_data", "processed_reviews.json")
     
-    reviews_data = load_reviews(input_file)
-    processed_data = asyncio.run(process_all_reviews(reviews_data, model=MODEL, max_concurrent=MAX_CONCURRENT, max_retries=MAX_RETRIES))
-    save_reviews(processed_data, output_file)
-
+    main(input_file, output_file, model=MODEL, max_concurrent=MAX_CONCURRENT, max_retries=MAX_RETRIES)
@@ -0,0 +1,68 @@
+"""
+Ограничение частоты запросов к LLM провайдерам.
+"""
+
+import asyncio
+import time
+
+
+class TokenBucketLimiter:
+    """
+    Асинхронный token bucket: не более rpm запросов в минуту.
+
+    Токены пополняются равномерно; capacity задает допустимый всплеск запросов.
+    """
+
+    def __init__(self, rpm: int, capacity: int = None):
+        if rpm <= 0:
+            raise ValueError("rpm должен быть положительным")
+        self.rate = rpm / 60.0
+        self.capacity = capacity if capacity is not None else max(1, rpm // 60)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ждет, пока появится свободный токен, и забирает его."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class LLMLimiter:
+    """
+    Общий ограничитель запросов к LLM: не более max_concurrent одновременных
+    запросов и (опционально) не более rpm запросов в минуту.
+
+    Один экземпляр передается во все этапы пайплайна, работающие с одним провайдером,
+    чтобы ограничения действовали на пайплайн целиком, а не на каждый этап отдельно.
+
+    Использование:
+        async with limiter:
+            await llm_request_async(...)
+    """
+
+    def __init__(self, max_concurrent: int, rpm: int = None):
+        self.max_concurrent = max_concurrent
+        self.rpm = rpm
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._bucket = TokenBucketLimiter(rpm) if rpm else None
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        if self._bucket is not None:
+            try:
+                await self._bucket.acquire()
+            except BaseException:
+                self._semaphore.release()
+                raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
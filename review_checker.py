@@ -1,44 +1,30 @@
 import json
 import os
-import sys
 import asyncio
 from datetime import datetime
 
-# Добавляем путь к папке llm для корректных импортов
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'llm'))
+from llm.llm_router import llm_request_async
+from llm_cache import cache_key, get_cached, set_cached
 
-from llm.llm_router import llm_request  # type: ignore
+# Путь к файлу pricing задается относительно этого модуля, а не текущей директории
+_PRICING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm", "llm_pricing.json")
 
+# Список доступных моделей загружается один раз при импорте модуля
+with open(_PRICING_PATH, "r", encoding="utf-8") as f:
+    _PRICING = json.load(f)
 
-async def check_review(review_text: str, gender: str = "", model: str = "grok-4-1-fast-reasoning") -> dict:
-    """
-    Асинхронно проверяет и корректирует отзыв через LLM модель.
-    
-    Args:
-        review_text: Текст отзыва для проверки
-        gender: Текущий пол (М/Ж/Н или пустая строка). По умолчанию пустая строка - модель определит сама
-        model: Название модели из списка pricing (по умолчанию "grok-4-1-fast-reasoning")
-        
-    Returns:
-        Словарь с полями:
-        - content: Ответ от модели в формате JSON {"text": "...", "gender": "..."}
-        - cost: Стоимость запроса в долларах
-        
-    Raises:
-        Exception: Если модель не найдена в pricing или не поддерживается
-    """
-    # Получаем текущую дату
-    current_date = datetime.now().strftime("%d.%m.%Y")
-    
-    # Формируем промпт с подстановкой параметров
-    prompt = f"""
+
+class UnknownModelError(ValueError):
+    """Модель не найдена в pricing. Ошибка конфигурации: повторять запрос бессмысленно."""
+
+
+# Части промпта: вступление и шаги проверки общие для одиночного и пакетного запроса
+_PROMPT_INTRO = """
     Ты профессиональный редактор отзывов. Задача проверить отзыв согласно входным данным и шагам.
     Исправляй текст последовательно согласно представленным шагам.
-    ВХОДНЫЕ ДАННЫЕ:
-    Текст отзыва: "{review_text}"
-    Текущий пол: {gender}
-    Текущая дата: {current_date}
-    Шаг 1. ОПРЕДЕЛЕНИЕ И КОРРЕКТИРОВКА ПОЛА
+"""
+
+_PROMPT_STEPS = """    Шаг 1. ОПРЕДЕЛЕНИЕ И КОРРЕКТИРОВКА ПОЛА
     Исправить текущий пол и окончания в тексте отзыва, под наиболее логически верный вариант:
     Текст написан преимущественно от женского лица + указан "М" (либо пол не указан) → изменить пол на "Ж" + скорректировать окончания (м→ж)
     Текст написан преимущественно от мужского лица + указан "Ж" (либо пол не указан) → изменить пол на "М" + скорректировать окончания (ж→м)
@@ -79,40 +65,284 @@ async def check_review(review_text: str, gender: str = "", model: str = "grok-4-
     - слова в которых "е" вместо "ё" (это не ошибка)
     - сленговые общеупотребительные слова, типа "замутить", "ништяк", "аудюшка", "бэха" и т.п. (это не ошибки)
     
-    ФОРМАТ ВЫДАЧИ:
-    {{ "text": "исправленный текст отзыва (или оригинал, если не требовалось правок)", "gender": "М/Ж/Н" }}
+"""
+
+_PROMPT_FORMAT = """    ФОРМАТ ВЫДАЧИ:
+    { "text": "исправленный текст отзыва (или оригинал, если не требовалось правок)", "gender": "М/Ж/Н" }
     ВАЖНО: Верни ТОЛЬКО JSON словарь. Никаких дополнительных объяснений, пояснений, обоснований или комментариев.
     """
+
+# Входные данные идут в самом конце промпта: неизменный префикс с инструкциями
+# позволяет провайдерам кэшировать его (prompt caching) между запросами
+_PROMPT_INPUT = """
+    ---
+    ВХОДНЫЕ ДАННЫЕ:
+    Текст отзыва: "{review_text}"
+    Текущий пол: {gender}
+    Текущая дата: {current_date}
+"""
+
+# Общий префикс одиночного промпта, одинаковый для всех отзывов
+_PROMPT_PREFIX = _PROMPT_INTRO + _PROMPT_STEPS + _PROMPT_FORMAT
+
+# Пакетный вариант: несколько отзывов в одном запросе, ответ - JSON массив
+_BATCH_PROMPT_NOTE = """    Отзывы приведены в конце в виде JSON массива объектов {"id": номер, "text": текст отзыва, "gender": текущий пол}.
+    Каждый отзыв обрабатывай независимо от остальных по шагам ниже.
+"""
+
+_BATCH_PROMPT_FORMAT = """    ФОРМАТ ВЫДАЧИ:
+    [ { "id": номер отзыва, "text": "исправленный текст отзыва (или оригинал, если не требовалось правок)", "gender": "М/Ж/Н" }, ... ]
+    Массив должен содержать ровно по одному объекту на каждый отзыв, с теми же id.
+    ВАЖНО: Верни ТОЛЬКО JSON массив. Никаких дополнительных объяснений, пояснений, обоснований или комментариев.
+    """
+
+_BATCH_PROMPT_PREFIX = _PROMPT_INTRO + _BATCH_PROMPT_NOTE + _PROMPT_STEPS + _BATCH_PROMPT_FORMAT
+
+_BATCH_PROMPT_INPUT = """
+    ---
+    Текущая дата: {current_date}
+    ОТЗЫВЫ:
+{reviews}"""
+
+
+def _current_date() -> str:
+    """Текущая дата с точностью до дня (формат ДД.ММ.ГГГГ)."""
+    return datetime.now().strftime("%d.%m.%Y")
+
+
+def build_review_parts(review_text: str, gender: str = "") -> tuple:
+    """
+    Формирует промпт для проверки отзыва в виде двух частей.
+    
+    Args:
+        review_text: Текст отзыва для проверки
+        gender: Текущий пол (М/Ж/Н или пустая строка)
+        
+    Returns:
+        Кортеж (неизменный префикс с инструкциями, входные данные отзыва)
+    """
+    suffix = _PROMPT_INPUT.format_map({
+        "review_text": review_text,
+        "gender": gender,
+        "current_date": _current_date()
+    })
+    return _PROMPT_PREFIX, suffix
+
+
+def build_messages(model: str, prefix: str, suffix: str) -> list:
+    """
+    Формирует список сообщений для llm_router из префикса и входных данных.
     
-    # Определяем путь к файлу pricing относительно корня проекта
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    llm_dir = os.path.join(current_dir, "llm")
-    pricing_path = os.path.join(llm_dir, "llm_pricing.json")
+    Для Claude префикс помечается cache_control: Anthropic кэширует промпт только
+    по явной отметке. Остальные провайдеры кэшируют общий префикс автоматически.
+    """
+    if model.startswith("claude-"):
+        content = [
+            {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": suffix}
+        ]
+        return [{"role": "user", "content": content}]
+    return [{"role": "user", "content": prefix + suffix}]
+
+
+def build_review_prompt(review_text: str, gender: str = "") -> str:
+    """
+    Формирует промпт для проверки и корректировки отзыва.
     
-    # Загружаем список доступных моделей из pricing
-    with open(pricing_path, "r", encoding="utf-8") as f:
-        pricing = json.load(f)
+    Args:
+        review_text: Текст отзыва для проверки
+        gender: Текущий пол (М/Ж/Н или пустая строка)
+        
+    Returns:
+        Текст промпта
+    """
+    prefix, suffix = build_review_parts(review_text, gender)
+    return prefix + suffix
+
+
+def build_reviews_batch_prompt(items: list) -> str:
+    """
+    Формирует промпт для пакетной проверки нескольких отзывов одним запросом.
     
-    # Проверяем, что модель есть в pricing
-    if model not in pricing:
-        available_models = ", ".join(pricing.keys())
-        raise Exception(
+    Args:
+        items: Список пар (текст отзыва, текущий пол)
+        
+    Returns:
+        Текст промпта
+    """
+    prefix, suffix = build_reviews_batch_parts(items)
+    return prefix + suffix
+
+
+def build_reviews_batch_parts(items: list) -> tuple:
+    """
+    Формирует пакетный промпт в виде двух частей.
+    
+    Args:
+        items: Список пар (текст отзыва, текущий пол)
+        
+    Returns:
+        Кортеж (неизменный префикс с инструкциями, дата и JSON массив отзывов)
+    """
+    reviews = [{"id": i, "text": text, "gender": gender} for i, (text, gender) in enumerate(items)]
+    suffix = _BATCH_PROMPT_INPUT.format_map({
+        "current_date": _current_date(),
+        "reviews": json.dumps(reviews, ensure_ascii=False)
+    })
+    return _BATCH_PROMPT_PREFIX, suffix
+
+
+class BatchResponseError(ValueError):
+    """Ответ на пакетный запрос не удалось разобрать. cost - стоимость уже оплаченного запроса."""
+    
+    def __init__(self, message: str, cost: float = 0.0):
+        super().__init__(message)
+        self.cost = cost
+
+
+def parse_batch_response(content: str, count: int) -> list:
+    """
+    Разбирает ответ модели на пакетный запрос.
+    
+    Args:
+        content: Ответ модели (JSON массив)
+        count: Количество отзывов в пакете
+        
+    Returns:
+        Список JSON строк {"text": ..., "gender": ...} в порядке отзывов пакета
+        
+    Raises:
+        ValueError: Если ответ не является массивом с результатом для каждого отзыва
+    """
+    items = json.loads(content)
+    if not isinstance(items, list):
+        raise ValueError("Ответ на пакетный запрос не является JSON массивом")
+    
+    by_id = {}
+    for item in items:
+        if isinstance(item, dict) and "text" in item:
+            try:
+                by_id[int(item.get("id"))] = item
+            except (TypeError, ValueError):
+                continue
+    
+    missing = [i for i in range(count) if i not in by_id]
+    if missing:
+        raise ValueError(f"В ответе на пакетный запрос нет отзывов с id: {missing}")
+    
+    return [
+        json.dumps({"text": by_id[i]["text"], "gender": by_id[i].get("gender", "")}, ensure_ascii=False)
+        for i in range(count)
+    ]
+
+
+def _check_model(model: str):
+    """Проверяет, что модель есть в pricing."""
+    if model not in _PRICING:
+        available_models = ", ".join(_PRICING.keys())
+        raise UnknownModelError(
             f"Модель '{model}' не найдена в pricing.\n"
             f"Доступные модели: {available_models}"
         )
+
+
+def _is_valid_response(content: str) -> bool:
+    """Проверяет, что ответ модели - JSON объект с полем text."""
+    try:
+        data = json.loads(content)
+    except (TypeError, ValueError):
+        return False
+    return isinstance(data, dict) and "text" in data
+
+
+async def check_review(review_text: str, gender: str = "", model: str = "grok-4-1-fast-reasoning") -> dict:
+    """
+    Асинхронно проверяет и корректирует отзыв через LLM модель.
+    
+    Args:
+        review_text: Текст отзыва для проверки
+        gender: Текущий пол (М/Ж/Н или пустая строка). По умолчанию пустая строка - модель определит сама
+        model: Название модели из списка pricing (по умолчанию "grok-4-1-fast-reasoning")
+        
+    Returns:
+        Словарь с полями:
+        - content: Ответ от модели в формате JSON {"text": "...", "gender": "..."}
+        - cost: Стоимость запроса в долларах
+        
+    Raises:
+        UnknownModelError: Если модель не найдена в pricing
+        Exception: Если модель не поддерживается llm_router
+    """
+    # Формируем промпт: неизменный префикс с инструкциями + входные данные отзыва
+    prefix, suffix = build_review_parts(review_text, gender)
+    
+    # Проверяем, что модель есть в pricing
+    _check_model(model)
+    
+    # Повторный запрос с тем же промптом берем из дискового кэша
+    key = cache_key(model, prefix + suffix)
+    cached = get_cached(key)
+    if cached is not None:
+        return cached
     
     # Формируем список сообщений в формате, который ожидает llm_router
-    messages = [
-        {"role": "user", "content": prompt}
-    ]
+    messages = build_messages(model, prefix, suffix)
     
-    # Выполняем запрос через llm_router в отдельном потоке (асинхронно)
-    # Это позволяет не блокировать event loop во время выполнения запроса
-    result = await asyncio.to_thread(llm_request, model, messages)
+    # Выполняем запрос через llm_router асинхронно: OpenAI-совместимые провайдеры
+    # работают через общий пул соединений без потоков, остальные - в отдельном потоке
+    result = await llm_request_async(model, messages)
+    
+    # В кэш попадают только ответы, которые удалось разобрать: иначе повторный запуск
+    # получил бы тот же неразобранный ответ бесплатно и без повторного запроса
+    if _is_valid_response(result.get("content", "")):
+        set_cached(key, result)
     
     return result
 
 
+async def check_reviews_batch(items: list, model: str = "grok-4-1-fast-reasoning") -> dict:
+    """
+    Асинхронно проверяет несколько отзывов одним запросом к LLM.
+    
+    Общие инструкции промпта оплачиваются один раз на пакет, а не на каждый отзыв.
+    
+    Args:
+        items: Список пар (текст отзыва, текущий пол)
+        model: Название модели из списка pricing
+        
+    Returns:
+        Словарь с полями:
+        - content: Список JSON строк {"text": "...", "gender": "..."} в порядке items
+        - cost: Стоимость всего запроса в долларах
+        
+    Raises:
+        BatchResponseError: Если ответ модели не удалось сопоставить с отзывами пакета
+            (в поле cost - стоимость запроса)
+        UnknownModelError: Если модель не найдена в pricing
+        Exception: Если модель не поддерживается llm_router
+    """
+    prefix, suffix = build_reviews_batch_parts(items)
+    _check_model(model)
+    
+    key = cache_key(model, prefix + suffix)
+    result = get_cached(key)
+    if result is None:
+        result = await llm_request_async(model, build_messages(model, prefix, suffix))
+        cost = result.get("cost", 0)
+    else:
+        cost = 0.0
+    
+    try:
+        contents = parse_batch_response(result.get("content", ""), len(items))
+    except ValueError as e:
+        raise BatchResponseError(str(e), cost) from e
+    
+    # В кэш попадают только ответы, которые удалось разобрать
+    set_cached(key, result)
+    
+    return {"content": contents, "cost": cost}
+
+
 if __name__ == "__main__":
     # Пример использования
     review_text = "Флорист просто чудо, собрала невероятный букет из роз и гербер, все в моих любимых оттенках. Привезли без опозданий (заказ онлайн оформляла), упаковка стильная, не мятая. Жена в восторге была, спасибо вам от души."
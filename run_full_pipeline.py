@@ -9,18 +9,95 @@
 
 import os
 import asyncio
+import hashlib
+import json
 import time
 
-from gsheets.fetch_reviews import fetch_reviews_from_sheets
-from process_reviews import process_all_reviews
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from gsheets.fetch_reviews import fetch_reviews_from_sheets, fetch_reviews_async
+from process_reviews import process_all_reviews, new_event_loop
+from rate_limiter import LLMLimiter
+from batch_submit import process_all_reviews_batch, supports_batch
 from gsheets.update_sheets import update_all_sheets
 from logger_config import get_pipeline_logger
 
 logger = get_pipeline_logger()
 
+# Хэш отзывов последнего успешно завершенного цикла
+LAST_HASH_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".last_reviews_hash")
+
+
+def reviews_hash(reviews: dict) -> str:
+    """Возвращает хэш содержимого отзывов (не зависит от порядка ключей)."""
+    if orjson is not None:
+        payload = orjson.dumps(reviews, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    else:
+        payload = json.dumps(reviews, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def read_last_hash() -> str:
+    """Читает хэш последнего успешного цикла (или None)."""
+    try:
+        with open(LAST_HASH_PATH, "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def all_processed(reviews: dict) -> bool:
+    """
+    Проверяет, что каждый непустой отзыв получил разобранный результат LLM.
+    
+    processed_at ставится только после успешного разбора ответа модели
+    (apply_check_result), ошибки запроса и неразобранные ответы его не получают.
+    """
+    return all(
+        "processed_at" in review
+        for worksheets in reviews.values()
+        for worksheet_reviews in worksheets.values()
+        for review in worksheet_reviews
+        if review.get("text", "")
+    )
+
+
+def write_last_hash(value: str):
+    """Сохраняет хэш успешно завершенного цикла."""
+    with open(LAST_HASH_PATH, "w", encoding="utf-8") as f:
+        f.write(value)
+
+
+async def run_llm_stages(reviews: dict, model: str, max_concurrent: int, max_retries: int, rpm: int = None) -> dict:
+    """Выполняет LLM этапы цикла с общим ограничителем запросов."""
+    # Ограничитель создается внутри цикла событий, в котором будет использоваться
+    limiter = LLMLimiter(max_concurrent, rpm)
+    return await process_all_reviews(
+        data=reviews,
+        model=model,
+        max_concurrent=max_concurrent,
+        max_retries=max_retries,
+        limiter=limiter
+    )
+
 
-def run_full_pipeline(model: str = "gpt-4o", max_concurrent: int = 100, max_retries: int = 3):
-    """Запускает полный цикл обработки отзывов."""
+def run_full_pipeline(model: str = "gpt-4o", max_concurrent: int = 100, max_retries: int = 3, use_batch: bool = False, rpm: int = None, runner: asyncio.Runner = None):
+    """
+    Запускает полный цикл обработки отзывов.
+    
+    При use_batch=True отзывы обрабатываются через Batch API (дешевле, но дольше),
+    если модель его поддерживает.
+    
+    Ограничения max_concurrent и rpm действуют на весь цикл: все LLM этапы
+    используют один общий LLMLimiter.
+    
+    runner - постоянный asyncio.Runner, переиспользуемый между циклами: пулы соединений
+    асинхронных клиентов при этом не пересоздаются. Если не передан, для цикла
+    создается временный.
+    """
     
     logger.info("="*60)
     logger.info("ЗАПУСК ПОЛНОГО ЦИКЛА ОБРАБОТКИ")
@@ -34,25 +111,49 @@ def run_full_pipeline(model: str = "gpt-4o", max_concurrent: int = 100, max_retr
     
     # Шаг 1: Получение данных из Google Sheets
     logger.info("ШАГ 1/3: Получение данных из Google Sheets")
-    reviews = fetch_reviews_from_sheets()
+    if runner is not None:
+        # Таблицы загружаются в том же цикле событий, что и LLM этапы
+        reviews = runner.run(fetch_reviews_async())
+    else:
+        reviews = fetch_reviews_from_sheets()
+    
+    # Если отзывы не изменились с прошлого успешного цикла, LLM и запись пропускаем
+    current_hash = reviews_hash(reviews)
+    if current_hash == read_last_hash():
+        logger.info("Отзывы не изменились с прошлого цикла, обработка пропущена")
+        return
     
     # Шаг 2: Проверка отзывов через LLM
     logger.info("ШАГ 2/3: Проверка отзывов через LLM")
-    processed_reviews = asyncio.run(process_all_reviews(
-        data=reviews,
-        model=model,
-        max_concurrent=max_concurrent,
-        max_retries=max_retries
-    ))
+    if use_batch and supports_batch(model):
+        processed_reviews = process_all_reviews_batch(data=reviews, model=model)
+    else:
+        if use_batch:
+            logger.warning(f"Модель {model} не поддерживает Batch API, используются обычные запросы")
+        stages = run_llm_stages(reviews, model, max_concurrent, max_retries, rpm)
+        if runner is not None:
+            processed_reviews = runner.run(stages)
+        else:
+            with asyncio.Runner(loop_factory=new_event_loop) as temp_runner:
+                processed_reviews = temp_runner.run(stages)
     
     # Шаг 3: Загрузка результатов в Google Sheets
     logger.info("ШАГ 3/3: Загрузка результатов в Google Sheets")
-    update_all_sheets(
+    sheets_updated = update_all_sheets(
         reviews_data=processed_reviews,
         sheets_config_path=sheets_config_file,
         credentials_path=credentials_file
     )
     
+    # Хэш сохраняется, только если все отзывы обработаны и записаны в таблицы:
+    # иначе следующий цикл получит те же незаполненные строки и должен их повторить
+    if not sheets_updated:
+        logger.warning("Не все листы обновлены, следующий цикл повторит обработку")
+    elif not all_processed(processed_reviews):
+        logger.warning("Не все отзывы обработаны, следующий цикл повторит обработку")
+    else:
+        write_last_hash(current_hash)
+    
     logger.info("="*60)
     logger.info("ЦИКЛ ЗАВЕРШЕН УСПЕШНО")
     logger.info("="*60)
@@ -62,30 +163,37 @@ if __name__ == "__main__":
     MODEL = "grok-4-1-fast-reasoning"
     MAX_CONCURRENT = 100
     MAX_RETRIES = 3
+    RPM = None  # Ограничение запросов к LLM в минуту на весь цикл (None - без ограничения)
+    USE_BATCH = False  # Batch API: скидка 50%, но результат может прийти в течение 24 часов
     SLEEP_MINUTES = 5  # Интервал между циклами в минутах
     
     logger.info("Запуск бесконечного цикла обработки")
     logger.info(f"Интервал между циклами: {SLEEP_MINUTES} минут")
     
-    while True:
-        try:
-            run_full_pipeline(
-                model=MODEL,
-                max_concurrent=MAX_CONCURRENT,
-                max_retries=MAX_RETRIES
-            )
-            
-            logger.info(f"Следующий запуск через {SLEEP_MINUTES} минут")
-            
-        except KeyboardInterrupt:
-            logger.info("ОСТАНОВЛЕНО ПОЛЬЗОВАТЕЛЕМ")
-            break
+    # Один цикл событий (uvloop, если установлен) на все запуски
+    with asyncio.Runner(loop_factory=new_event_loop) as runner:
+        while True:
+            try:
+                run_full_pipeline(
+                    model=MODEL,
+                    max_concurrent=MAX_CONCURRENT,
+                    max_retries=MAX_RETRIES,
+                    use_batch=USE_BATCH,
+                    rpm=RPM,
+                    runner=runner
+                )
+                
+                logger.info(f"Следующий запуск через {SLEEP_MINUTES} минут")
+                
+            except KeyboardInterrupt:
+                logger.info("ОСТАНОВЛЕНО ПОЛЬЗОВАТЕЛЕМ")
+                break
+                
+            except Exception as e:
+                logger.error(f"ОШИБКА: {e}", exc_info=True)
+                logger.info(f"Следующая попытка через {SLEEP_MINUTES} минут")
             
-        except Exception as e:
-            logger.error(f"ОШИБКА: {e}", exc_info=True)
-            logger.info(f"Следующая попытка через {SLEEP_MINUTES} минут")
-        
-        # Ожидание перед следующим циклом
-        sleep_seconds = SLEEP_MINUTES * 60
-        time.sleep(sleep_seconds)
+            # Ожидание перед следующим циклом
+            sleep_seconds = SLEEP_MINUTES * 60
+            time.sleep(sleep_seconds)
 
@@ -1,39 +1,64 @@
 import asyncio
+import hashlib
 import json
 import os
+import re
 import sys
-from datetime import datetime
+import time
+from string import Template
+from collections import OrderedDict
+from contextlib import nullcontext
+from pathlib import Path
 
-# Добавляем путь к папке llm для корректных импортов
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'llm'))
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-from llm.llm_router import llm_request  # type: ignore
+try:
+    from spellchecker import SpellChecker
+except ImportError:
+    SpellChecker = None
 
+from llm.llm_router import llm_request_async, ResponseTooLongError
+from llm_cache import CACHE_TTL, cache_key, get_cached, set_cached
+from rate_limiter import LLMLimiter
+from logger_config import get_spelling_logger
 
-async def check_spelling(text: str, model: str = "grok-4-1-fast-reasoning") -> dict:
-    """
-    Асинхронно находит и помечает орфографические ошибки в тексте.
-    
-    Args:
-        text: Текст для проверки орфографии
-        model: Название модели из списка pricing (по умолчанию "grok-4-1-fast-reasoning")
-        
-    Returns:
-        Словарь с полями:
-        - content: Текст с помеченными ошибками в формате [[]]
-        - cost: Стоимость запроса в долларах
-        
-    Raises:
-        Exception: Если модель не найдена в pricing или не поддерживается
-    """
-    # Формируем промпт
-    prompt = f"""
+logger = get_spelling_logger()
+
+
+# Пути задаются относительно этого модуля, а не текущей директории
+_HERE = Path(__file__).resolve().parent
+_PRICING_PATH = _HERE / "llm" / "llm_pricing.json"
+
+# Список доступных моделей загружается один раз при импорте модуля
+if orjson is not None:
+    _PRICING = orjson.loads(_PRICING_PATH.read_bytes())
+else:
+    _PRICING = json.loads(_PRICING_PATH.read_text(encoding="utf-8"))
+
+
+class UnknownModelError(ValueError):
+    """Модель не найдена в pricing. Ошибка конфигурации: повторять запрос бессмысленно."""
+
+
+# Набор доступных моделей и строка для сообщения об ошибке готовятся один раз
+_MODELS = frozenset(_PRICING)
+_AVAILABLE = ", ".join(_PRICING)
+
+# Кэш ответов в памяти процесса: (модель, хэш текста) -> (время истечения, ответ).
+# Срабатывает раньше дискового кэша и не зависит от наличия diskcache
+MEMORY_CACHE_SIZE = 10_000
+_memory_cache = OrderedDict()
+
+# Части промпта; правила разметки общие для одиночной и пакетной проверки
+_PROMPT_INTRO = """
     Ты профессиональный корректор текстов. Твоя задача — найти ВСЕ орфографические ошибки в тексте и пометить ТОЛЬКО неправильные буквы.
     
-    ТЕКСТ ДЛЯ ПРОВЕРКИ:
-    "{text}"
-    
-    ЗАДАЧА:
+"""
+
+_PROMPT_RULES = """    ЗАДАЧА:
     Найди все орфографические ошибки и опечатки в тексте.
     Заключи КАЖДУЮ неправильную букву в двойные квадратные скобки [[]].
     
@@ -52,50 +77,439 @@ async def check_spelling(text: str, model: str = "grok-4-1-fast-reasoning") -> d
     - Букву "е" вместо "ё" (это не ошибка)
     - Грамматические окончания (это не орфографические ошибки)
     
-    ВАЖНО: Верни ТОЛЬКО текст с пометками. Никаких дополнительных объяснений или комментариев.
+"""
+
+_PROMPT_FORMAT = """    ВАЖНО: Верни ТОЛЬКО текст с пометками. Никаких дополнительных объяснений или комментариев.
+    """
+
+_PROMPT_INPUT = """    ТЕКСТ ДЛЯ ПРОВЕРКИ:
+    "$text"
+    
+"""
+
+# Шаблон одиночного промпта собирается один раз; при вызове подставляется только text.
+# string.Template не разбирает фигурные скобки, поэтому в правилах их не нужно экранировать
+_PROMPT_TEMPLATE = Template(_PROMPT_INTRO + _PROMPT_INPUT + _PROMPT_RULES + _PROMPT_FORMAT)
+
+# Пакетный вариант: тексты разделены маркерами ===TEXT n===, ответы - маркерами <<<n>>>
+_BATCH_PROMPT_NOTE = """    Тексты для проверки приведены в конце, каждый после строки вида ===TEXT n===.
+    Каждый текст проверяй отдельно.
+    
+"""
+
+_BATCH_PROMPT_FORMAT = """    ФОРМАТ ВЫДАЧИ:
+    Для каждого текста выведи строку <<<n>>> (n - номер текста), а на следующей строке - текст с пометками.
+    Верни ответы для всех текстов в том же порядке.
+    ВАЖНО: Никаких дополнительных объяснений или комментариев.
+    
+"""
+
+_BATCH_RESPONSE_RE = re.compile(r'<<<(\d+)>>>')
+
+# Ответ только добавляет пометки [[]] к исходному тексту, поэтому ответ длиннее
+# 2 * len(text) + OUTPUT_SLACK - это рассуждения модели: такой поток прерывается
+OUTPUT_SLACK = 64
+
+# Модели без рассуждений, которым передаются temperature=0 и max_tokens. Reasoning
+# модели (gpt-5, grok-4-1-fast-reasoning, deepseek-reasoner, gemini) часть параметров не
+# принимают, а рассуждения расходуют max_tokens, поэтому для них остаются значения по умолчанию
+_SAMPLING_MODEL_PREFIXES = ("gpt-4", "claude-", "deepseek-chat", "grok-4-1-fast-non-reasoning")
+
+# Пометка ошибки в ответе модели: [[буква]] (тот же формат, что читает gsheets.update_sheets)
+_MARK_RE = re.compile(r'\[\[(.*?)\]\]')
+
+# Длинные тексты делятся по границам предложений на части не длиннее CHUNK_CHARS,
+# которые проверяются параллельными запросами. Разделители сохраняются для склейки
+CHUNK_CHARS = 500
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?…])(\s+)')
+
+# Максимальная длина проверяемого текста по умолчанию: остаток более длинного текста
+# возвращается без проверки, чтобы ограничить стоимость одного вызова
+MAX_CHARS = 8000
+
+# Проверяется русская орфография: тексты без кириллицы в LLM не отправляются
+_CYRILLIC_RE = re.compile(r'[А-Яа-яЁё]')
+
+# Слова для локальной предварительной проверки словарем
+_WORD_RE = re.compile(r'[А-Яа-яЁё]+')
+_speller = None
+
+
+def parse_markers(content: str) -> list:
     """
+    Находит пометки ошибок [[...]] в размеченном тексте.
     
-    # Определяем путь к файлу pricing относительно корня проекта
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    llm_dir = os.path.join(current_dir, "llm")
-    pricing_path = os.path.join(llm_dir, "llm_pricing.json")
+    Returns:
+        Список пар (позиция пометки в content, помеченный текст)
+    """
+    return [(m.start(), m.group(1)) for m in _MARK_RE.finditer(content)]
+
+
+def find_suspects(text: str) -> list:
+    """
+    Находит слова, которых нет в локальном русском словаре (pyspellchecker).
     
-    # Загружаем список доступных моделей из pricing
-    with open(pricing_path, "r", encoding="utf-8") as f:
-        pricing = json.load(f)
+    Returns:
+        Отсортированный список подозрительных слов в нижнем регистре
+        
+    Raises:
+        ImportError: Если не установлен pyspellchecker
+    """
+    global _speller
+    if SpellChecker is None:
+        raise ImportError("Для локальной проверки словарем нужен пакет pyspellchecker")
+    if _speller is None:
+        _speller = SpellChecker(language="ru")
     
-    # Проверяем, что модель есть в pricing
-    if model not in pricing:
-        available_models = ", ".join(pricing.keys())
-        raise Exception(
+    # "е" вместо "ё" ошибкой не считается
+    words = {word.lower().replace("ё", "е") for word in _WORD_RE.findall(text)}
+    return sorted(_speller.unknown(words))
+
+
+def _check_model(model: str):
+    """Проверяет, что модель есть в pricing."""
+    if model not in _MODELS:
+        raise UnknownModelError(
             f"Модель '{model}' не найдена в pricing.\n"
-            f"Доступные модели: {available_models}"
+            f"Доступные модели: {_AVAILABLE}"
         )
+
+
+def _output_limit(text_length: int) -> int:
+    """Максимальная допустимая длина ответа для текста длины text_length."""
+    return 2 * text_length + OUTPUT_SLACK
+
+
+def _generation_params(model: str, output_limit: int) -> dict:
+    """
+    Параметры генерации для ответа не длиннее output_limit символов (см. _output_limit).
+    
+    Разметка детерминирована, поэтому temperature=0. Кириллица и пометки [[]] могут
+    занимать больше одного токена на символ, поэтому max_tokens берется равным
+    лимиту длины потокового ответа, а не длине текста: корректный ответ не обрезается.
+    """
+    if not model.startswith(_SAMPLING_MODEL_PREFIXES):
+        return None
+    return {"temperature": 0, "max_tokens": output_limit}
+
+
+async def _call_llm(model: str, prompt: str, max_output_chars: int = None, params: dict = None, limiter: LLMLimiter = None) -> dict:
+    """
+    Выполняет запрос к LLM, прерывая слишком длинный потоковый ответ.
     
-    # Формируем список сообщений в формате, который ожидает llm_router
-    messages = [
-        {"role": "user", "content": prompt}
-    ]
+    Если ответ прерван, запрос один раз повторяется без ограничения длины.
+    limiter (если передан) захватывается на каждый запрос к модели.
+    """
+    messages = [{"role": "user", "content": prompt}]
+    if max_output_chars is None:
+        async with limiter or nullcontext():
+            return await llm_request_async(model, messages, params=params)
+    try:
+        async with limiter or nullcontext():
+            return await llm_request_async(model, messages, max_output_chars, params)
+    except ResponseTooLongError as e:
+        logger.warning(f"{e}, повторный запрос без потокового режима")
+        async with limiter or nullcontext():
+            return await llm_request_async(model, messages, params=params)
+
+
+def _is_valid_markup(content: str, text: str) -> bool:
+    """
+    Проверяет размеченный ответ: без пометок [[]] и обрамляющих кавычек он должен
+    совпадать с исходным текстом (разметка не добавляет и не удаляет буквы).
+    """
+    return _MARK_RE.sub(r"\1", _strip_quotes(content, text)) == text
+
+
+async def _request(model: str, prompt: str, max_output_chars: int = None, params: dict = None, limiter: LLMLimiter = None, text: str = None) -> dict:
+    """
+    Выполняет запрос к LLM с использованием дискового кэша.
     
-    # Выполняем запрос через llm_router в отдельном потоке (асинхронно)
-    result = await asyncio.to_thread(llm_request, model, messages)
+    Если передан text (проверяемый текст), в кэш попадает только ответ, прошедший
+    проверку _is_valid_markup: обрезанный, переписанный моделью или полученный после
+    прерывания слишком длинного ответа результат не кэшируется.
+    """
+    # Повторный запрос с тем же промптом берем из дискового кэша
+    key = cache_key(model, prompt)
+    cached = get_cached(key)
+    if cached is not None:
+        return cached
+    
+    # Выполняем запрос через llm_router асинхронно: OpenAI-совместимые провайдеры
+    # работают через общий пул соединений без потоков, остальные - в отдельном потоке
+    result = await _call_llm(model, prompt, max_output_chars, params, limiter)
+    if text is None or _is_valid_markup(result.get("content", ""), text):
+        set_cached(key, result)
     
     return result
 
 
-if __name__ == "__main__":
-    # Пример использования
+def split_sentences(text: str, max_chars: int = CHUNK_CHARS) -> list:
+    """
+    Делит текст на части по границам предложений.
+    
+    Returns:
+        Список пар (часть, разделитель после нее); "".join(часть + разделитель)
+        дает исходный текст. Предложение длиннее max_chars остается целым
+    """
+    pieces = _SENTENCE_SPLIT_RE.split(text)
+    chunks = []
+    current = pieces[0]
+    # pieces: [предложение, разделитель, предложение, ...]
+    for separator, sentence in zip(pieces[1::2], pieces[2::2]):
+        if len(current) + len(separator) + len(sentence) <= max_chars:
+            current += separator + sentence
+        else:
+            chunks.append((current, separator))
+            current = sentence
+    chunks.append((current, ""))
+    return chunks
+
+
+def _split_head(text: str, max_chars: int) -> tuple:
+    """Делит текст на начало не длиннее max_chars (по границе предложения) и остаток."""
+    head = split_sentences(text, max_chars)[0][0]
+    if len(head) > max_chars:
+        head = text[:max_chars]
+    return head, text[len(head):]
+
+
+def _strip_quotes(content: str, chunk: str) -> str:
+    """Снимает одну пару кавычек, в которые модель обернула ответ (если их не было в тексте)."""
+    if (len(content) >= 2 and content.startswith('"') and content.endswith('"')
+            and not (chunk.startswith('"') and chunk.endswith('"'))):
+        return content[1:-1]
+    return content
+
+
+async def _check_spelling_one(text: str, model: str, limiter: LLMLimiter = None) -> dict:
+    """Проверяет один текст; длинный текст проверяется по частям параллельно."""
+    chunks = split_sentences(text) if len(text) > CHUNK_CHARS else [(text, "")]
+    if len(chunks) == 1:
+        return await _request(
+            model, _PROMPT_TEMPLATE.substitute(text=text),
+            _output_limit(len(text)), _generation_params(model, _output_limit(len(text))), limiter, text
+        )
+    
+    results = await asyncio.gather(*[
+        _request(
+            model, _PROMPT_TEMPLATE.substitute(text=chunk),
+            _output_limit(len(chunk)), _generation_params(model, _output_limit(len(chunk))), limiter, chunk
+        )
+        for chunk, _ in chunks
+    ])
+    # Кавычки вокруг ответа на часть оказались бы в середине склеенного текста
+    return {
+        "content": "".join(
+            _strip_quotes(result["content"], chunk) + separator
+            for result, (chunk, separator) in zip(results, chunks)
+        ),
+        "cost": sum(result.get("cost", 0) for result in results)
+    }
+
+
+def build_batch_prompt(texts: list) -> str:
+    """Формирует промпт для проверки нескольких текстов одним запросом."""
+    blocks = "".join(f"===TEXT {n}===\n{text}\n" for n, text in enumerate(texts, 1))
+    return _PROMPT_INTRO + _BATCH_PROMPT_NOTE + _PROMPT_RULES + _BATCH_PROMPT_FORMAT + blocks
+
+
+def parse_batch_response(content: str, count: int) -> dict:
+    """
+    Разбирает ответ на пакетный запрос.
+    
+    Returns:
+        Словарь номер текста (с 0) -> текст с пометками; тексты, для которых
+        ответа нет, в словарь не попадают
+    """
+    parts = _BATCH_RESPONSE_RE.split(content)
+    marked = {}
+    # parts: [преамбула, номер, текст, номер, текст, ...]
+    for number, body in zip(parts[1::2], parts[2::2]):
+        index = int(number) - 1
+        if 0 <= index < count and index not in marked:
+            marked[index] = body.strip()
+    return marked
+
+
+async def _check_spelling_chunk(texts: list, model: str, limiter: LLMLimiter = None) -> list:
+    """Проверяет пакет текстов одним запросом; тексты без ответа проверяются по одному."""
+    if len(texts) == 1:
+        return [await _check_spelling_one(texts[0], model, limiter)]
+    
+    prompt = build_batch_prompt(texts)
+    key = cache_key(model, prompt)
+    result = get_cached(key)
+    if result is None:
+        # Лимит учитывает маркеры <<<n>>> для каждого текста
+        limit = sum(_output_limit(len(text)) for text in texts)
+        params = _generation_params(model, limit)
+        result = await _call_llm(model, prompt, limit, params, limiter)
+    
+    marked = parse_batch_response(result.get("content", ""), len(texts))
+    if len(marked) == len(texts):
+        # В кэш попадают только полностью разобранные ответы
+        set_cached(key, result)
+    
+    # Тексты без ответа проверяются по одному параллельно; общий лимит соблюдает limiter
+    missing = [i for i in range(len(texts)) if i not in marked]
+    singles = dict(zip(missing, await asyncio.gather(*[
+        _check_spelling_one(texts[i], model, limiter) for i in missing
+    ])))
+    
+    # Стоимость пакета делится поровну; повторные запросы оплачиваются отдельно
+    share = result.get("cost", 0) / len(texts)
+    results = []
+    for i in range(len(texts)):
+        if i in marked:
+            results.append({"content": marked[i], "cost": share})
+        else:
+            results.append({"content": singles[i]["content"], "cost": singles[i]["cost"] + share})
+    return results
+
+
+async def check_spelling_batch(texts: list, model: str = "grok-4-1-fast-reasoning", batch_size: int = 16, local_prefilter: bool = False, max_chars: int = MAX_CHARS, limiter: LLMLimiter = None) -> list:
+    """
+    Асинхронно находит и помечает орфографические ошибки в нескольких текстах.
+    
+    Тексты отправляются пакетами по batch_size в одном запросе: общие инструкции
+    промпта оплачиваются один раз на пакет. Пакеты выполняются параллельно.
+    
+    Args:
+        texts: Список текстов для проверки
+        model: Название модели из списка pricing
+        batch_size: Количество текстов в одном запросе
+        local_prefilter: Сначала проверять тексты локальным словарем (pyspellchecker) и
+            отправлять в LLM только тексты с незнакомыми словарю словами. Экономит запросы
+            на чистых текстах, но пропускает опечатки, дающие другое существующее слово
+        max_chars: Максимальная длина проверяемой части текста. У более длинного текста
+            проверяется начало (до границы предложения), остаток возвращается без пометок
+        limiter: Ограничитель запросов (LLMLimiter). Захватывается на каждый запрос к модели,
+            включая части длинных текстов и повторы, поэтому пакеты и части выполняются
+            параллельно, но в пределах общих лимитов. Вызывающий код не должен сам
+            удерживать этот limiter на время вызова
+        
+    Returns:
+        Список словарей {"content": текст с пометками, "cost": стоимость} в порядке texts
+        
+    Raises:
+        UnknownModelError: Если модель не найдена в pricing
+        Exception: Если модель не поддерживается llm_router
+    """
+    _check_model(model)
+    
+    # Пустые тексты и тексты без кириллицы возвращаются как есть, без запроса
+    results = [{"content": text, "cost": 0.0} for text in texts]
+    pending = [i for i, text in enumerate(texts) if _CYRILLIC_RE.search(text)]
+    if local_prefilter:
+        pending = [i for i in pending if find_suspects(texts[i])]
+    
+    # Слишком длинные тексты проверяются только до max_chars
+    heads = {i: texts[i] for i in pending}
+    tails = {}
+    for i in pending:
+        if len(texts[i]) > max_chars:
+            heads[i], tails[i] = _split_head(texts[i], max_chars)
+            logger.warning(
+                f"Текст длиной {len(texts[i])} символов длиннее max_chars={max_chars}: "
+                f"проверяются первые {len(heads[i])} символов"
+            )
+    
+    chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    chunk_results = await asyncio.gather(*[
+        _check_spelling_chunk([heads[i] for i in chunk], model, limiter) for chunk in chunks
+    ])
+    for chunk, chunk_result in zip(chunks, chunk_results):
+        for i, result in zip(chunk, chunk_result):
+            if i in tails:
+                result = {**result, "content": result["content"] + tails[i]}
+            results[i] = result
+    return results
+
+
+async def check_spelling(text: str, model: str = "grok-4-1-fast-reasoning", local_prefilter: bool = False, max_chars: int = MAX_CHARS, limiter: LLMLimiter = None) -> dict:
+    """
+    Асинхронно находит и помечает орфографические ошибки в тексте.
+    
+    Args:
+        text: Текст для проверки орфографии
+        model: Название модели из списка pricing (по умолчанию "grok-4-1-fast-reasoning")
+        local_prefilter: Не отправлять в LLM текст, все слова которого есть в локальном
+            словаре (см. check_spelling_batch)
+        max_chars: Максимальная длина проверяемой части текста (см. check_spelling_batch)
+        limiter: Ограничитель запросов, захватываемый на каждый запрос к модели
+            (см. check_spelling_batch)
+        
+    Returns:
+        Словарь с полями:
+        - content: Текст с помеченными ошибками в формате [[]]
+        - cost: Стоимость запроса в долларах
+        
+    Raises:
+        UnknownModelError: Если модель не найдена в pricing
+        Exception: Если модель не поддерживается llm_router
+    """
+    key = (model, local_prefilter, max_chars, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+    entry = _memory_cache.get(key)
+    if entry is not None:
+        expires_at, cached = entry
+        if expires_at > time.monotonic():
+            _memory_cache.move_to_end(key)
+            return {"content": cached["content"], "cost": 0.0, "cached": True}
+        del _memory_cache[key]
+    
+    results = await check_spelling_batch([text], model=model, batch_size=1, local_prefilter=local_prefilter, max_chars=max_chars, limiter=limiter)
+    result = results[0]
+    
+    _memory_cache[key] = (time.monotonic() + CACHE_TTL, result)
+    _memory_cache.move_to_end(key)
+    if len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+    
+    return result
+
+
+async def check_spelling_many(texts: list, model: str = "grok-4-1-fast-reasoning", concurrency: int = 20, qpm: int = None) -> list:
+    """
+    Асинхронно проверяет орфографию многих текстов параллельными запросами.
+    
+    Args:
+        texts: Список текстов для проверки
+        model: Название модели из списка pricing
+        concurrency: Максимальное количество одновременных запросов
+        qpm: Ограничение запросов в минуту (по умолчанию из переменной окружения
+            SPELLING_QPM; без нее - без ограничения)
+        
+    Returns:
+        Список результатов check_spelling в порядке texts. Ошибка одного запроса
+        не отменяет остальные: на ее месте в списке будет исключение
+    """
+    if qpm is None:
+        qpm = int(os.getenv("SPELLING_QPM", "0")) or None
+    limiter = LLMLimiter(concurrency, qpm)
+    
+    # Лимит действует на каждый запрос к модели, в том числе на части длинных текстов
+    return await asyncio.gather(*[
+        check_spelling(text=text, model=model, limiter=limiter) for text in texts
+    ], return_exceptions=True)
+
+
+# Пример использования; запускается только при SPELLING_DEMO=1, чтобы запуск модуля
+# без этой переменной не отправлял платный запрос к модели
+if __name__ == "__main__" and os.environ.get("SPELLING_DEMO"):
     test_text = "Отличный салон. Ноль стреса. Первый раз заказали с мужем машшину из-за гроницы, конечно, очень переживали, но тьфу-тьфу все прошло спокойно. Меннеджеры подобрали для нас Audi A5 с пробегом 78 тыс. Машина в отличном состоянии, прошла ТО, в оригинальной комплектации. Берите лучше сопровождение под ключ. Услуга дороже, но удобнее в сто раз."
     model = "grok-4-1-fast-reasoning"
     
     result = asyncio.run(check_spelling(text=test_text, model=model))
     
-    print("\n" + "="*60)
-    print("РЕЗУЛЬТАТ ПРОВЕРКИ ОРФОГРАФИИ")
-    print("="*60)
-    print(f"Модель: {model}")
-    print(f"Исходный текст: {test_text}")
-    print(f"\nРезультат: {result['content']}")
-    print(f"Стоимость: ${result['cost']:.6f}")
-    print("="*60 + "\n")
+    sys.stdout.write("\n".join([
+        "\n" + "="*60,
+        "РЕЗУЛЬТАТ ПРОВЕРКИ ОРФОГРАФИИ",
+        "="*60,
+        f"Модель: {model}",
+        f"Исходный текст: {test_text}",
+        f"\nРезультат: {result['content']}",
+        f"Стоимость: ${result['cost']:.6f}",
+        "="*60 + "\n",
+    ]) + "\n")
 